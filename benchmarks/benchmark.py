@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""
+Purpose: CPU microbenchmarks of Layers primitives, Data batching and Mnist loading, on synthetic data
+Usage:
+    python benchmarks/benchmark.py --output results.json
+    python benchmarks/benchmark.py --output results.json --baseline baseline.json --threshold 0.15
+Results are a JSON dict of benchmark name to {'value', 'unit', 'higher_is_better'}. With --baseline, every
+benchmark that got worse by more than threshold is reported and the exit code is 1.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tensorflow as tf
+import numpy as np
+
+from tensorbase.base import Data, Layers, set_verbosity
+from tensorbase.data import Mnist
+
+# name: (input shape, function building the layer on a Layers instance, Layers keyword arguments)
+LAYER_CASES = {
+    'conv2d_3x3_32x32x16_to_32': ([16, 32, 32, 16], lambda l: l.conv2d(3, 32), {}),
+    'conv2d_3x3_64x64x32_to_64': ([16, 64, 64, 32], lambda l: l.conv2d(3, 64), {}),
+    'conv2d_3x3_32x32x16_to_32_moving_bn': ([16, 32, 32, 16], lambda l: l.conv2d(3, 32), {'training': True}),
+    'conv2d_3x3_32x32x16_to_32_fused_bn': ([16, 32, 32, 16], lambda l: l.conv2d(3, 32),
+                                           {'training': True, 'fused': True}),
+    'conv2d_3x3_32x32x16_to_32_no_bn': ([16, 32, 32, 16], lambda l: l.conv2d(3, 32, bn=False), {}),
+    'res_layer_32x32x32': ([16, 32, 32, 32], lambda l: l.res_layer(32), {}),
+    'res_layer_32x32x32_to_64_stride2': ([16, 32, 32, 32], lambda l: l.res_layer(64, stride=2), {}),
+    'res_layer_bottle_16x16x64': ([16, 16, 16, 64], lambda l: l.res_layer(64, bottle=True), {}),
+    'batch_norm_32x32x32': ([16, 32, 32, 32], lambda l: setattr(l, 'input', l.batch_norm(l.input)), {}),
+    'fc_1024_to_512': ([64, 1024], lambda l: l.fc(512), {}),
+    'fc_4096_to_1024': ([64, 4096], lambda l: l.fc(1024), {}),
+}
+
+
+def timed_runs(fn, repeats, warmup):
+    """ Returns the median wall time of fn in milliseconds """
+    for _ in range(warmup):
+        fn()
+    times = list()
+    for _ in range(repeats):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return 1000 * float(np.median(times))
+
+
+def benchmark_layers(results, repeats, warmup, name_filter=''):
+    """ Graph construction, forward and forward+backward time of every layer case """
+    for name, (shape, build, kwargs) in sorted(LAYER_CASES.items()):
+        if name_filter not in name:
+            continue
+        graph = tf.Graph()
+        with graph.as_default():
+            start = time.time()
+            x = tf.placeholder(tf.float32, shape)
+            layers = Layers(x, **kwargs)
+            build(layers)
+            output = layers.get_output()
+            variables = tf.trainable_variables()
+            gradients = tf.gradients(tf.reduce_sum(output), [x] + variables)
+            results['build/' + name] = (1000 * (time.time() - start), 'ms', False)
+            update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+            init = tf.global_variables_initializer()
+        feed_dict = {x: np.random.standard_normal(shape).astype(np.float32)}
+        with tf.Session(graph=graph) as sess:
+            sess.run(init)
+            results['forward/' + name] = (
+                timed_runs(lambda: sess.run(output, feed_dict=feed_dict), repeats, warmup), 'ms', False)
+            results['forward_backward/' + name] = (
+                timed_runs(lambda: sess.run([gradients, update_ops], feed_dict=feed_dict), repeats, warmup),
+                'ms', False)
+
+
+class SyntheticData(Data):
+    """ Random MNIST-sized uint8 images with class indices """
+
+    def __init__(self, flags, num_images=20000, **kwargs):
+        self.num_images = num_images
+        super().__init__(flags, **kwargs)
+
+    def load_data(self, test_percent=0.15):
+        rng = np.random.RandomState(0)
+        images = rng.randint(0, 256, size=(self.num_images, 28, 28, 1)).astype(np.uint8)
+        labels = rng.randint(0, 10, size=self.num_images).astype(np.uint8)
+        num_test = int(self.num_images * test_percent)
+        return images[num_test:], labels[num_test:], images[:num_test], labels[:num_test]
+
+
+def benchmark_data(results, batch_size, num_batches, name_filter=''):
+    """ next_train_batch throughput of the Data batching options """
+    settings = {'default': {}, 'index_shuffle': {'index_shuffle': True},
+                'index_shuffle_preallocate': {'index_shuffle': True, 'preallocate': True},
+                'graph_preprocess': {'index_shuffle': True, 'preprocess': 'graph'}}
+    for name, kwargs in sorted(settings.items()):
+        if name_filter not in 'data/next_train_batch_' + name:
+            continue
+        data = SyntheticData({}, num_classes=10, **kwargs)
+        data.next_train_batch(batch_size)
+        start = time.time()
+        for _ in range(num_batches):
+            data.next_train_batch(batch_size)
+        results['data/next_train_batch_' + name] = (batch_size * num_batches / (time.time() - start),
+                                                    'examples/sec', True)
+
+
+def write_idx(filename, magic, array):
+    """ Writes a gzipped IDX file as served on the MNIST site """
+    header = np.array([magic, len(array)] + list(array.shape[1:3]), dtype='>u4')
+    with gzip.open(filename, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(array.tobytes())
+
+
+def benchmark_mnist(results, num_train=20000, num_test=5000, name_filter=''):
+    """ Mnist.load_data time from the .gz files (cold) and from the .npy cache (warm). The warm load needs the
+    cold one, so all three are run if any of their names matches name_filter, and only the matching ones kept. """
+    names = ['data/mnist_load_' + name for name in ['cold', 'warm', 'uncached']]
+    if not any(name_filter in name for name in names):
+        return
+    timings = dict()
+    directory = tempfile.mkdtemp()
+    try:
+        rng = np.random.RandomState(0)
+        for prefix, num in [('train', num_train), ('t10k', num_test)]:
+            write_idx(os.path.join(directory, prefix + '-images-idx3-ubyte.gz'), 2051,
+                      rng.randint(0, 256, size=(num, 28, 28)).astype(np.uint8))
+            write_idx(os.path.join(directory, prefix + '-labels-idx1-ubyte.gz'), 2049,
+                      rng.randint(0, 10, size=num).astype(np.uint8))
+        for name in ['cold', 'warm']:
+            start = time.time()
+            Mnist({'data_directory': directory})
+            timings['data/mnist_load_' + name] = (1000 * (time.time() - start), 'ms', False)
+        start = time.time()
+        Mnist({'data_directory': directory}, cache=False)
+        timings['data/mnist_load_uncached'] = (1000 * (time.time() - start), 'ms', False)
+    finally:
+        shutil.rmtree(directory)
+    results.update((name, timing) for name, timing in timings.items() if name_filter in name)
+
+
+def compare(results, baseline, threshold):
+    """ Returns a list of (name, baseline value, value, relative slowdown) for regressions beyond threshold """
+    regressions = list()
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['value'], result['value']
+        if old <= 0 or new <= 0:
+            continue
+        slowdown = old / new - 1 if result['higher_is_better'] else new / old - 1
+        if slowdown > threshold:
+            regressions.append((name, old, new, slowdown))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file for the results')
+    parser.add_argument('--baseline', default=None, help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown flagged as regression')
+    parser.add_argument('--repeats', type=int, default=20, help='timed session runs per layer benchmark')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed session runs per layer benchmark')
+    parser.add_argument('--filter', default='', help='only run the layer cases and data benchmarks whose name '
+                                                      'contains this string, e.g. "conv2d" or "data/mnist_load"')
+    args = parser.parse_args()
+
+    set_verbosity(0)
+    tuples = dict()
+    benchmark_layers(tuples, args.repeats, args.warmup, args.filter)
+    benchmark_data(tuples, batch_size=128, num_batches=1000, name_filter=args.filter)
+    benchmark_mnist(tuples, name_filter=args.filter)
+    results = {name: {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+               for name, (value, unit, higher_is_better) in tuples.items()}
+    for name, result in sorted(results.items()):
+        print('%-60s %12.3f %s' % (name, result['value'], result['unit']))
+    with open(args.output, 'w') as f:
+        json.dump({'tensorflow': tf.__version__, 'numpy': np.__version__, 'results': results}, f, indent=2)
+    print('Results written to', args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, old, new, slowdown in regressions:
+            print('REGRESSION %s: %.3f -> %.3f (%.1f%% worse)' % (name, old, new, 100 * slowdown))
+        if regressions:
+            sys.exit(1)
+        print('No regressions beyond %.0f%% against %s' % (100 * args.threshold, args.baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,15 +8,60 @@ Classes:
     Model
 """
 
-import tensorflow as tf
 import numpy as np
+import atexit
+import importlib
+import json
 import logging
 import math
 import os
-
-from tensorflow.python import pywrap_tensorflow
+import queue
+import re
+import threading
+import time
 import sys
 
+
+class _LazyModule:
+    """ Imports a module on first attribute access, so Data and its subclasses can be used without paying for
+    the TensorFlow import until a Model or Layers needs it """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+tf = _LazyModule('tensorflow')
+
+
+def relu(x):
+    """ Default activation_fn of the Layers methods, resolving tf.nn.relu only when a layer is built """
+    return tf.nn.relu(x)
+
+
+# Verbosity shared by Model, Layers and their subclasses, see set_verbosity
+_verbosity = 2
+
+
+def set_verbosity(level):
+    """
+    Sets how much Model and Layers print: 0 for warnings only, 1 for progress messages,
+    2 (default) to also print every layer output shape, variable name and the flags
+    :param level: int
+    """
+    global _verbosity
+    _verbosity = level
+
+
+def get_verbosity():
+    return _verbosity
+
+
 class Data:
     """
     A Class to handle data I/O and batching in TensorFlow.
@@ -28,8 +73,25 @@ class Data:
         - That use queueing and threading fuctions in TesnorFlow
     """
 
-    def __init__(self, flags, valid_percent=0.2, test_percent=0.15):
+    def __init__(self, flags, valid_percent=0.2, test_percent=0.15, index_shuffle=False, preallocate=False,
+                 dtype=np.float32, num_classes=None, preprocess='host'):
+        """
+        :param flags: dict
+        :param valid_percent: float, fraction of the train data held out for validation
+        :param test_percent: float, passed to load_data
+        :param index_shuffle: bool, shuffle a permutation index at each epoch instead of copying the train arrays
+        :param preallocate: bool, write training batches into reused buffers instead of allocating new arrays
+        :param dtype: numpy dtype of normalized images and one-hot labels in each batch
+        :param num_classes: int. If set, labels are stored as class indices and one-hot encoded per batch
+        :param preprocess: 'host' to normalize batches in numpy, or 'graph' to return the stored uint8 images
+            and labels unchanged, for graph_preprocess to normalize inside the TensorFlow graph
+        """
         self.flags = flags
+        self.index_shuffle = index_shuffle
+        self.preallocate = preallocate
+        self.dtype = dtype
+        self.num_classes = num_classes
+        self.preprocess = preprocess
         train_images, train_labels, self.test_images, self.test_labels = self.load_data(test_percent)
         self._num_test_images = len(self.test_labels)
         self._num_train_images = math.floor(len(train_labels) * (1 - valid_percent))
@@ -42,6 +104,19 @@ class Data:
         self.index_in_valid_epoch = 0
         self.index_in_test_epoch = 0
 
+        # Index-based shuffling and reused batch buffers, see _make_batch
+        self._train_perm = None
+        self._batch_buffers = list()
+        self._buffer_index = 0
+        self._num_batch_buffers = 1
+
+        # Background prefetching of training batches, see start_prefetch
+        self._rng = np.random
+        self._prefetch_queue = None
+        self._prefetch_thread = None
+        self._prefetch_stop = None
+        self._prefetch_batch_size = None
+
     def load_data(self, test_percent=0.15):
         """Load the dataset into memory. If data is not divided into train/test, use test_percent to divide the data"""
         train_images = list()
@@ -69,6 +144,17 @@ class Data:
         :return train_labels: list, of labels
         :return images: list, of images
         """
+        if self._prefetch_thread is None:
+            return self._next_train_batch(batch_size)
+        assert batch_size == self._prefetch_batch_size, 'batch_size must match the one given to start_prefetch'
+        batch = self._prefetch_queue.get()
+        if isinstance(batch, Exception):
+            self.stop_prefetch()
+            raise batch
+        return batch
+
+    def _next_train_batch(self, batch_size):
+        """ Slices, shuffles and normalizes the next training batch on the calling thread """
         start = self.index_in_train_epoch
         self.index_in_train_epoch += batch_size
         if self.index_in_train_epoch > self.num_train_images:
@@ -76,10 +162,15 @@ class Data:
             self.train_epochs_completed += 1
 
             # Shuffle the data
-            perm = np.arange(self.num_train_images)
-            np.random.shuffle(perm)
-            self.train_images = self.train_images[perm]
-            self.train_labels = self.train_labels[perm]
+            if self.index_shuffle:  # keep the arrays in place and gather batches through the permutation
+                if self._train_perm is None:
+                    self._train_perm = np.arange(self.num_train_images)
+                self._rng.shuffle(self._train_perm)
+            else:
+                perm = np.arange(self.num_train_images)
+                self._rng.shuffle(perm)
+                self.train_images = self.train_images[perm]
+                self.train_labels = self.train_labels[perm]
 
             # Start next epoch
             start = 0
@@ -87,7 +178,76 @@ class Data:
             assert batch_size <= self.num_train_images
 
         end = self.index_in_train_epoch
-        return self.train_labels[start:end], self.img_norm(self.train_images[start:end])
+        if self._train_perm is None:
+            index = slice(start, end)
+        else:
+            index = self._train_perm[start:end]
+        return self._make_batch(self.train_labels, self.train_images, index)
+
+    def _make_batch(self, labels, images, index):
+        """
+        Gathers and normalizes a batch, writing into the next reused buffer if preallocate is set.
+        Buffers are recycled, so a preallocated batch is only valid until the following call.
+        :param labels: numpy array of labels
+        :param images: numpy array of images
+        :param index: slice or numpy array of indices into labels and images
+        :return labels, images: batch
+        """
+        gather = not isinstance(index, slice)
+        if not self.preallocate:
+            if gather:
+                return self._process_batch(np.take(labels, index, axis=0), np.take(images, index, axis=0))
+            return self._process_batch(labels[index], images[index])
+        batch_size = len(index) if gather else index.stop - index.start
+        label_buf, image_buf, label_out, image_out = self._next_batch_buffer(labels, images, batch_size)
+        if gather:
+            np.take(labels, index, axis=0, out=label_buf)
+            np.take(images, index, axis=0, out=image_buf)
+        else:
+            label_buf[...] = labels[index]
+            image_buf[...] = images[index]
+        return self._process_batch(label_buf, image_buf, label_out, image_out)
+
+    def _process_batch(self, labels, images, label_out=None, image_out=None):
+        """ Applies the storage policy to a batch of stored labels and images, see __init__ """
+        if self.preprocess == 'graph':
+            return labels, images
+        if self.num_classes is not None:
+            labels = self.one_hot(labels, self.num_classes, dtype=self.dtype, out=label_out)
+        return labels, self.img_norm(images, dtype=self.dtype, out=image_out)
+
+    def _next_batch_buffer(self, labels, images, batch_size):
+        """ Returns the next (labels, images, processed labels, processed images) buffers in the ring """
+        self._buffer_index = (self._buffer_index + 1) % self._num_batch_buffers
+        while len(self._batch_buffers) < self._num_batch_buffers:
+            self._batch_buffers.append(None)
+        buffers = self._batch_buffers[self._buffer_index]
+        if buffers is None or len(buffers[0]) != batch_size:
+            label_out = image_out = None
+            if self.preprocess != 'graph':
+                image_out = np.empty((batch_size,) + images.shape[1:], dtype=self.dtype)
+                if self.num_classes is not None:
+                    label_out = np.empty((batch_size, self.num_classes), dtype=self.dtype)
+            buffers = (np.empty((batch_size,) + labels.shape[1:], dtype=labels.dtype),
+                       np.empty((batch_size,) + images.shape[1:], dtype=images.dtype), label_out, image_out)
+            self._batch_buffers[self._buffer_index] = buffers
+        return buffers
+
+    def graph_preprocess(self, images, labels=None, max_val=255):
+        """
+        In-graph version of the storage policy, for use with preprocess='graph'
+        :param images: tf.Tensor of stored (uint8) images
+        :param labels: tf.Tensor of stored labels, or None
+        :param max_val: int, maximum value of input tensor
+        :return: normalized images, and labels one-hot encoded if num_classes is set
+        """
+        dtype = tf.as_dtype(self.dtype)
+        images = (tf.cast(images, dtype) * (2 / max_val)) - 1
+        if labels is None:
+            return images
+        if self.num_classes is not None:
+            labels = tf.one_hot(tf.cast(labels, tf.int32), self.num_classes, dtype=dtype)
+        return images, labels
 
     def next_valid_batch(self, batch_size):
         """
@@ -101,7 +261,8 @@ class Data:
             batch_size = 1
         self.index_in_valid_epoch += batch_size
         end = self.index_in_valid_epoch
-        return self.valid_labels[start:end], self.img_norm(self.valid_images[start:end]), end, batch_size
+        labels, images = self._process_batch(self.valid_labels[start:end], self.valid_images[start:end])
+        return labels, images, end, batch_size
 
     def next_test_batch(self, batch_size):
         """
@@ -111,12 +272,96 @@ class Data:
         :return images: list, of images
         """
         start = self.index_in_test_epoch
-        print(start)
         if self.index_in_test_epoch + batch_size > self.num_test_images:
             batch_size = 1
         self.index_in_test_epoch += batch_size
         end = self.index_in_test_epoch
-        return self.test_labels[start:end], self.img_norm(self.test_images[start:end]), end, batch_size
+        labels, images = self._process_batch(self.test_labels[start:end], self.test_images[start:end])
+        return labels, images, end, batch_size
+
+    def eval_batches(self, batch_size, split='valid', pad=False):
+        """
+        Iterates once over a whole split in full batches plus one final partial batch.
+        Independent of the next_valid_batch and next_test_batch counters.
+        :param batch_size: int
+        :param split: string, 'train', 'valid' or 'test'
+        :param pad: bool, zero-pad the final batch to batch_size, for graphs with a fixed batch dimension.
+            Otherwise the final batch is smaller (ragged)
+        :return: generator of (labels, images, mask), mask is a bool numpy array marking the real examples
+        """
+        labels = getattr(self, split + '_labels')
+        images = getattr(self, split + '_images')
+        num_images = len(labels)
+        for start in range(0, num_images, batch_size):
+            end = min(start + batch_size, num_images)
+            batch_labels, batch_images = self._process_batch(labels[start:end], images[start:end])
+            mask = np.ones(end - start, dtype=bool)
+            if pad and end - start < batch_size:
+                padding = batch_size - (end - start)
+                batch_labels = np.concatenate([batch_labels, np.zeros((padding,) + batch_labels.shape[1:],
+                                                                      dtype=batch_labels.dtype)])
+                batch_images = np.concatenate([batch_images, np.zeros((padding,) + batch_images.shape[1:],
+                                                                      dtype=batch_images.dtype)])
+                mask = np.concatenate([mask, np.zeros(padding, dtype=bool)])
+            yield batch_labels, batch_images, mask
+
+    def start_prefetch(self, batch_size, num_batches=4, seed=None):
+        """
+        Prepare training batches on a background thread while the session runs.
+        A single worker slices batches like next_train_batch, but shuffles each epoch with its own RandomState so
+        that the shuffles do not depend on how the training thread uses np.random. The batch order is therefore
+        deterministic under SEED from run to run, but after the first epoch it differs from the order that
+        next_train_batch produces without prefetching.
+        Note that train_epochs_completed is advanced by the worker and so runs up to num_batches ahead.
+        :param batch_size: int, size of image batch returned by next_train_batch
+        :param num_batches: int, maximum number of batches staged ahead of the training thread
+        :param seed: int, seed for the shuffles. If None, drawn from np.random (deterministic under SEED)
+        """
+        if self._prefetch_thread is not None:
+            self.stop_prefetch()
+        if seed is None:
+            seed = np.random.randint(2 ** 31 - 1)
+        self._rng = np.random.RandomState(seed)
+        self._num_batch_buffers = num_batches + 2  # staged batches, the one in use, and the one being written
+        self._prefetch_batch_size = batch_size
+        self._prefetch_queue = queue.Queue(maxsize=num_batches)
+        self._prefetch_stop = threading.Event()
+        self._prefetch_thread = threading.Thread(target=self._prefetch_worker, args=(batch_size,),
+                                                 name='tensorbase-prefetch', daemon=True)
+        self._prefetch_thread.start()
+
+    def stop_prefetch(self):
+        """ Stops the prefetch worker and discards any staged batches. Safe to call more than once. """
+        if self._prefetch_thread is None:
+            return
+        self._prefetch_stop.set()
+        while self._prefetch_thread.is_alive():
+            try:  # unblock a worker waiting on a full queue
+                self._prefetch_queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._prefetch_thread.join(timeout=0.1)
+        self._prefetch_thread = None
+        self._prefetch_queue = None
+        self._prefetch_stop = None
+        self._prefetch_batch_size = None
+        self._num_batch_buffers = 1
+
+    def _prefetch_worker(self, batch_size):
+        """ Runs on the prefetch thread. Exceptions are passed to the training thread through the queue. """
+        while not self._prefetch_stop.is_set():
+            try:
+                batch = self._next_train_batch(batch_size)
+            except Exception as e:  # pylint: disable=broad-except
+                batch = e
+            while not self._prefetch_stop.is_set():
+                try:
+                    self._prefetch_queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if isinstance(batch, Exception):
+                return
 
     @property
     def num_train_images(self):
@@ -131,35 +376,132 @@ class Data:
         return self._num_valid_images
 
     @staticmethod
-    def img_norm(x, max_val=255):
+    def img_norm(x, max_val=255, out=None, dtype=None):
         """
         Normalizes stack of images
         :param x: input feature map stack, assume uint8
         :param max_val: int, maximum value of input tensor
+        :param out: numpy array, optional float buffer of the same shape to write the result into
+        :param dtype: numpy dtype of the output. Defaults to float64
         :return: output feature map stack
         """
-        return (x * (1 / max_val) - 0.5) * 2  # returns scaled input ranging from [-1, 1]
+        if out is None and dtype is None:
+            return (x * (1 / max_val) - 0.5) * 2  # returns scaled input ranging from [-1, 1]
+        out = np.multiply(x, 2 / max_val, out=out, dtype=dtype if out is None else out.dtype)
+        out -= 1
+        return out
+
+    @staticmethod
+    def one_hot(labels, num_classes, dtype=np.float32, out=None):
+        """
+        Converts a batch of class indices to one-hot vectors
+        :param labels: numpy array of integer labels, shape (batch,)
+        :param num_classes: int
+        :param dtype: numpy dtype of the output
+        :param out: numpy array, optional buffer of shape (batch, num_classes)
+        :return: numpy array (batch, num_classes)
+        """
+        if out is None:
+            out = np.zeros((len(labels), num_classes), dtype=dtype)
+        else:
+            out.fill(0)
+        out[np.arange(len(labels)), labels] = 1
+        return out
 
     @classmethod
     def batch_inputs(cls, read_and_decode_fn, tf_file, batch_size, mode="train", num_readers=4, num_threads=4,
-                     min_examples=1000):
+                     min_examples=1000, worker_index=0, num_workers=1, compression=None):
+        """
+        Queue runner input pipeline. Start it with init_threads.
+        :param tf_file: string or list of strings, TFRecord filenames or glob patterns. With several files,
+            each of the num_readers readers pulls a different file from the shared filename queue.
+        :param worker_index: int, index of this worker when the files are sharded between workers
+        :param num_workers: int, number of workers sharing the files, see list_files
+        :param compression: None, 'GZIP' or 'ZLIB', compression of the TFRecord files
+        """
+        tf_files = cls.list_files(tf_file, worker_index, num_workers)
         with tf.name_scope('batch_processing'):
-            example_serialized = cls.queue_setup(tf_file, mode, batch_size, num_readers, min_examples)
+            example_serialized = cls.queue_setup(tf_files, mode, batch_size, num_readers, min_examples,
+                                                 compression)
             decoded_data = cls.thread_setup(read_and_decode_fn, example_serialized, num_threads)
             return tf.train.batch_join(decoded_data, batch_size=batch_size)
 
+    @classmethod
+    def dataset_inputs(cls, read_and_decode_fn, tf_files, batch_size, mode="train", num_readers=4, num_threads=4,
+                       min_examples=1000, prefetch_batches=2, worker_index=0, num_workers=1, compression=None):
+        """
+        tf.data alternative to batch_inputs. Needs no queue runners, so init_threads is not required.
+        Files are read in parallel by interleaving, examples are shuffled (train mode only), decoded by a
+        parallel map, batched and prefetched.
+        :param read_and_decode_fn: function from a serialized example to a list of tensors, as in batch_inputs
+        :param tf_files: string or list of strings, TFRecord filenames or glob patterns
+        :param batch_size: int
+        :param mode: "train" to shuffle files and examples, otherwise files are read in order
+        :param num_readers: int, number of files read concurrently
+        :param num_threads: int, number of parallel decode calls
+        :param min_examples: int, shuffle buffer size is min_examples + 3 * batch_size, as in queue_setup
+        :param prefetch_batches: int, number of batches prepared ahead of the session
+        :param worker_index: int, index of this worker when the files are sharded between workers
+        :param num_workers: int, number of workers sharing the files, see list_files
+        :param compression: None, 'GZIP' or 'ZLIB', compression of the TFRecord files
+        :return: list of batched tensors
+        """
+        tf_files = cls.list_files(tf_files, worker_index, num_workers)
+        with tf.name_scope('dataset_processing'):
+            files = tf.data.Dataset.from_tensor_slices(tf_files)
+            if mode == "train":
+                files = files.shuffle(len(tf_files))
+            files = files.repeat()
+            dataset = files.apply(tf.contrib.data.parallel_interleave(
+                lambda filename: tf.data.TFRecordDataset(filename, compression_type=compression or ''),
+                cycle_length=num_readers, sloppy=(mode == "train")))
+            if mode == "train":
+                dataset = dataset.shuffle(min_examples + 3 * batch_size)
+            dataset = dataset.map(lambda example: tuple(read_and_decode_fn(example)), num_parallel_calls=num_threads)
+            dataset = dataset.batch(batch_size).prefetch(prefetch_batches)
+            return list(dataset.make_one_shot_iterator().get_next())
+
+    @staticmethod
+    def list_files(tf_files, worker_index=0, num_workers=1):
+        """
+        Expands glob patterns and returns the files of one worker.
+        Files are sorted so that every worker computes the same deterministic split.
+        :param tf_files: string or list of strings, filenames or glob patterns
+        :param worker_index: int, in [0, num_workers)
+        :param num_workers: int
+        :return: list of strings
+        """
+        if isinstance(tf_files, str):
+            tf_files = [tf_files]
+        filenames = list()
+        for pattern in tf_files:
+            matches = tf.gfile.Glob(pattern)
+            if not matches:
+                raise ValueError('No files match %s' % pattern)
+            filenames.extend(f for f in sorted(matches) if f not in filenames)
+        if not 0 <= worker_index < num_workers:
+            raise ValueError('worker_index must be in [0, %d). Received: %d' % (num_workers, worker_index))
+        shard = filenames[worker_index::num_workers]
+        if not shard:
+            raise ValueError('%d files cannot be sharded between %d workers' % (len(filenames), num_workers))
+        return shard
+
     @staticmethod
-    def queue_setup(filename, mode, batch_size, num_readers, min_examples):
-        """ Sets up the queue runners for data input """
-        filename_queue = tf.train.string_input_producer([filename], shuffle=True, capacity=16)
+    def queue_setup(filename, mode, batch_size, num_readers, min_examples, compression=None):
+        """ Sets up the queue runners for data input. filename can be a string or a list of strings. """
+        filenames = [filename] if isinstance(filename, str) else list(filename)
+        filename_queue = tf.train.string_input_producer(filenames, shuffle=True, capacity=16)
         if mode == "train":
             examples_queue = tf.RandomShuffleQueue(capacity=min_examples + 3 * batch_size,
                                                    min_after_dequeue=min_examples, dtypes=[tf.string])
         else:
             examples_queue = tf.FIFOQueue(capacity=min_examples + 3 * batch_size, dtypes=[tf.string])
+        options = None
+        if compression is not None:
+            options = tf.python_io.TFRecordOptions(getattr(tf.python_io.TFRecordCompressionType, compression))
         enqueue_ops = list()
         for _ in range(num_readers):
-            reader = tf.TFRecordReader()
+            reader = tf.TFRecordReader(options=options)
             _, value = reader.read(filename_queue)
             enqueue_ops.append(examples_queue.enqueue([value]))
         tf.train.queue_runner.add_queue_runner(tf.train.queue_runner.QueueRunner(examples_queue, enqueue_ops))
@@ -189,6 +531,82 @@ class Data:
         coord.request_stop()
         coord.join(threads, stop_grace_period_secs=10)
 
+    @staticmethod
+    def open_memmap(filename, dtype=np.uint8, shape=None):
+        """
+        Opens an array file read-only without reading it into memory
+        :param filename: string, .npy file or raw binary file
+        :param dtype: numpy dtype, element type of a raw file
+        :param shape: tuple, shape of a single example in a raw file
+        :return: numpy memmap with examples along the first axis
+        """
+        if filename.endswith('.npy'):
+            return np.load(filename, mmap_mode='r')
+        if shape is None:
+            raise ValueError('The example shape of raw file %s must be specified' % filename)
+        return np.memmap(filename, dtype=dtype, mode='r').reshape((-1,) + tuple(shape))
+
+
+class MemmapData(Data):
+    """
+    A Data backend for datasets that do not fit in memory.
+    Images and labels are opened as read-only memory maps, so the train/valid/test splits are views,
+    batches are read from disk lazily and the page cache is shared by all processes on the host.
+    Epochs are always shuffled through a permutation index (see index_shuffle in Data).
+    Expects train_images, train_labels and optionally test_images, test_labels in flags['data_directory'],
+    each as a .npy file or a raw .bin file. Override data_files to use other names.
+    """
+
+    def __init__(self, flags, valid_percent=0.2, test_percent=0.15, image_shape=None, image_dtype=np.uint8,
+                 label_shape=(), label_dtype=np.uint8, **kwargs):
+        """
+        :param image_shape: tuple, shape of one image. Only needed for raw files
+        :param image_dtype: numpy dtype of raw image files
+        :param label_shape: tuple, shape of one label. Only needed for raw files
+        :param label_dtype: numpy dtype of raw label files
+        :param kwargs: Data arguments. index_shuffle is always True
+        """
+        self.image_shape = image_shape
+        self.image_dtype = image_dtype
+        self.label_shape = label_shape
+        self.label_dtype = label_dtype
+        kwargs['index_shuffle'] = True  # shuffling the arrays themselves would read them all into memory
+        super().__init__(flags, valid_percent, test_percent, **kwargs)
+
+    def data_files(self):
+        """ Returns a dict of array name to file path, or None if the file does not exist """
+        files = dict()
+        for name in ['train_images', 'train_labels', 'test_images', 'test_labels']:
+            files[name] = None
+            for ext in ['.npy', '.bin']:
+                filepath = os.path.join(self.flags['data_directory'], name + ext)
+                if os.path.exists(filepath):
+                    files[name] = filepath
+                    break
+        return files
+
+    def load_data(self, test_percent=0.15):
+        """ Memory-maps the dataset. If there are no test files, the first test_percent of train is used. """
+        files = self.data_files()
+        for name in ['train_images', 'train_labels']:
+            if files[name] is None:
+                base = os.path.join(self.flags['data_directory'], name)
+                raise FileNotFoundError('MemmapData needs %s.npy or %s.bin' % (base, base))
+        train_images = self.open_memmap(files['train_images'], self.image_dtype, self.image_shape)
+        train_labels = self.open_memmap(files['train_labels'], self.label_dtype, self.label_shape)
+        if files['test_images'] is None or files['test_labels'] is None:
+            num_test = int(len(train_labels) * test_percent)
+            return train_images[num_test:], train_labels[num_test:], train_images[:num_test], train_labels[:num_test]
+        test_images = self.open_memmap(files['test_images'], self.image_dtype, self.image_shape)
+        test_labels = self.open_memmap(files['test_labels'], self.label_dtype, self.label_shape)
+        return train_images, train_labels, test_images, test_labels
+
+    def _make_batch(self, labels, images, index):
+        """ Reads the examples of a shuffled batch in file order, which keeps disk access mostly sequential """
+        if not isinstance(index, slice):
+            index = np.sort(index)
+        return super()._make_batch(labels, images, index)
+
 
 class Model:
     """
@@ -197,23 +615,50 @@ class Model:
         See list in __init__() function
     """
 
+    # Collection of expensive summaries (histograms, images), merged into merged_histograms
+    HISTOGRAM_SUMMARIES = 'histogram_summaries'
+
+    # Top-level scopes created by Layers, used to attribute profiled ops (including their gradients) to layers
+    LAYER_SCOPE = re.compile(r'(?:^|/|update_)((?:conv|deconv|fc|flat|maxpool|avgpool|resnet)_\d+|noisyAND)(?:/|:|$)')
+    GRADIENT_OP = re.compile(r'(?:^|/)gradients(?:_\d+)?/')
+    UPDATE_OP = re.compile(r'(?:^|/)update_')
+
     def __init__(self, flags, config_dict=None):
         config_yaml_flags_dict = self.load_config_yaml(flags, config_dict)
+        if config_yaml_flags_dict.get('VERBOSITY') is not None:
+            set_verbosity(config_yaml_flags_dict['VERBOSITY'])
         config_yaml_flags_dict_none = self.check_dict_keys(config_yaml_flags_dict)
 
         # Define constants
         self.step = 1
         self.flags = config_yaml_flags_dict_none
-
-        # Run initialization functions
-        self._check_file_io()
-        self._data()
+        self._eval_metric_ops = dict()
+        self._checkpointer = None
+        self._best_saver = None
+        self._best_metric = None
+        self.accumulate_op = None
+        self.accumulation_steps = 1
+
+        # Run initialization functions, timing each one
+        self.init_times = dict()
+        self._timed(self._check_file_io)
+        self._timed(self._data)
         self._set_seed()
-        self._network()
-        self._optimizer()
-        self._summaries()
-        self.merged, self.saver, self.sess, self.writer = self._set_tf_functions()
-        self._initialize_model()
+        self._timed(self._network)
+        self._timed(self._optimizer)
+        self._timed(self._summaries)
+        self.merged_scalars, self.merged_histograms = self._merge_summary_tiers()
+        self.merged, self.saver, self.sess, self.writer = self._timed(self._set_tf_functions)
+        self._timed(self._initialize_model)
+        self.print_log('Initialization times: ' + ', '.join('%s %.2fs' % (name, seconds) for name, seconds in
+                                                             self.init_times.items()))
+
+    def _timed(self, fn):
+        """ Runs an initialization function and records its wall time in self.init_times """
+        start = time.time()
+        result = fn()
+        self.init_times[fn.__name__] = time.time() - start
+        return result
 
     def load_config_yaml(self, flags, config_dict):
         """ Load config dict and yaml dict and then override both with flags dict. """
@@ -240,11 +685,14 @@ class Model:
         for key in optional_keys:
             if key not in config_yaml_flags_dict:
                 config_yaml_flags_dict[key] = None
-                print('%s in flags, yaml or config dictionary was not found.' % key)
-        if 'RUN_NUM' not in config_yaml_flags_dict:
-            config_yaml_flags_dict['RUN_NUM'] = 0
-        if 'NUM_EPOCHS' not in config_yaml_flags_dict:
-            config_yaml_flags_dict['NUM_EPOCHS'] = 1
+                self.print_log('%s in flags, yaml or config dictionary was not found.' % key, level=2)
+        default_keys = {'RUN_NUM': 0, 'NUM_EPOCHS': 1, 'BATCH_SIZE': None, 'ASYNC_CHECKPOINT': False,
+                        'CHECKPOINTS_TO_KEEP': 5, 'SUMMARY_EVERY': 1, 'HISTOGRAM_EVERY': 100, 'CHECKPOINT_EVERY': None,
+                        'DISPLAY_EVERY': 100, 'INTRA_OP_THREADS': 0, 'INTER_OP_THREADS': 0, 'GRAPH_OPT_LEVEL': 'L1',
+                        'GRAPH_REWRITES': None, 'XLA_JIT': False, 'PROFILE_EVERY': None, 'ACCUMULATION_STEPS': 1}
+        for key, value in default_keys.items():
+            if key not in config_yaml_flags_dict:
+                config_yaml_flags_dict[key] = value
         return config_yaml_flags_dict
 
     def _check_file_io(self):
@@ -256,22 +704,85 @@ class Model:
         self.flags['LOGGING_DIRECTORY'] = self.flags['SAVE_DIRECTORY'] + self.flags[
             'MODEL_DIRECTORY'] + folder
         self.make_directory(self.flags['LOGGING_DIRECTORY'])
-        sys.stdout = Logger(self.flags['LOGGING_DIRECTORY'] + 'ModelInformation.log')
-        print(self.flags)
+        self.logger = Logger(self.flags['LOGGING_DIRECTORY'] + 'ModelInformation.log')
+        sys.stdout = self.logger
+        self.print_log(self.flags, level=2)
 
     def _set_tf_functions(self):
         """ Sets up summary writer, saver, and session, with configurable gpu visibility """
-        merged = tf.summary.merge_all()
-        saver = tf.train.Saver()
+        summaries = tf.get_collection(tf.GraphKeys.SUMMARIES) + tf.get_collection(self.HISTOGRAM_SUMMARIES)
+        merged = tf.summary.merge(summaries) if summaries else None
+        saver = tf.train.Saver(max_to_keep=self.flags['CHECKPOINTS_TO_KEEP'])
         if type(self.flags['GPU']) is int:
             os.environ["CUDA_VISIBLE_DEVICES"] = str(self.flags['GPU'])
             print('Using GPU %d' % self.flags['GPU'])
-        gpu_options = tf.GPUOptions(allow_growth=True)
-        config = tf.ConfigProto(log_device_placement=False, gpu_options=gpu_options)
-        sess = tf.Session(config=config)
+        sess = tf.Session(config=self._session_config())
         writer = tf.summary.FileWriter(self.flags['LOGGING_DIRECTORY'], sess.graph)
         return merged, saver, sess, writer
 
+    def _session_config(self, intra_op_threads=None, inter_op_threads=None, per_session_threads=False):
+        """
+        Builds the session ConfigProto from the flags:
+            INTRA_OP_THREADS, INTER_OP_THREADS: int, 0 lets TensorFlow pick (one thread per core)
+            GRAPH_OPT_LEVEL: 'L0' or 'L1', graph optimizer level (constant folding, common subexpressions)
+            GRAPH_REWRITES: dict of RewriterConfig field to 'ON' or 'OFF', e.g. {'layout_optimizer': 'OFF'}
+            XLA_JIT: bool, compile the graph with XLA, including on CPU
+        :param intra_op_threads: int, overrides INTRA_OP_THREADS
+        :param inter_op_threads: int, overrides INTER_OP_THREADS
+        :param per_session_threads: bool, give the session its own thread pools instead of the process-wide ones
+        """
+        from tensorflow.core.protobuf import rewriter_config_pb2
+        if intra_op_threads is None:
+            intra_op_threads = self.flags['INTRA_OP_THREADS']
+        if inter_op_threads is None:
+            inter_op_threads = self.flags['INTER_OP_THREADS']
+        optimizer_options = tf.OptimizerOptions(opt_level=getattr(tf.OptimizerOptions, self.flags['GRAPH_OPT_LEVEL']))
+        if self.flags['XLA_JIT']:
+            optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+            os.environ.setdefault('TF_XLA_FLAGS', '--tf_xla_cpu_global_jit')  # global jit is GPU-only otherwise
+        rewrite_options = rewriter_config_pb2.RewriterConfig()
+        for field, toggle in (self.flags['GRAPH_REWRITES'] or dict()).items():
+            setattr(rewrite_options, field, getattr(rewriter_config_pb2.RewriterConfig, toggle))
+        graph_options = tf.GraphOptions(optimizer_options=optimizer_options, rewrite_options=rewrite_options)
+        gpu_options = tf.GPUOptions(allow_growth=True)
+        return tf.ConfigProto(log_device_placement=False, gpu_options=gpu_options, graph_options=graph_options,
+                              intra_op_parallelism_threads=intra_op_threads,
+                              inter_op_parallelism_threads=inter_op_threads,
+                              use_per_session_threads=per_session_threads)
+
+    def tune_threads(self, feed_dict, fetches=None, settings=None, num_steps=10, warmup_steps=2):
+        """
+        Times fetches under several thread settings. Each setting runs in its own session on the model graph,
+        with freshly initialized variables, so self.sess is left untouched.
+        :param feed_dict: dict, a representative batch
+        :param fetches: tf.Operation or list. Defaults to self.optimizer
+        :param settings: list of (intra_op_threads, inter_op_threads). Defaults to a grid based on the CPU count
+        :param num_steps: int, timed steps per setting
+        :param warmup_steps: int, untimed steps per setting
+        :return: fastest (intra_op_threads, inter_op_threads), and a dict of setting to seconds per step
+        """
+        fetches = self.optimizer if fetches is None else fetches
+        if settings is None:
+            cpus = os.cpu_count() or 1
+            settings = sorted({(0, 0), (cpus, 1), (cpus, 2), (max(cpus // 2, 1), 2), (max(cpus // 4, 1), 4)})
+        init_ops = [tf.global_variables_initializer(), tf.local_variables_initializer()]
+        results = dict()
+        for intra_op_threads, inter_op_threads in settings:
+            config = self._session_config(intra_op_threads, inter_op_threads, per_session_threads=True)
+            with tf.Session(graph=self.sess.graph, config=config) as sess:
+                sess.run(init_ops)
+                for _ in range(warmup_steps):
+                    sess.run(fetches, feed_dict=feed_dict)
+                start = time.time()
+                for _ in range(num_steps):
+                    sess.run(fetches, feed_dict=feed_dict)
+                results[(intra_op_threads, inter_op_threads)] = (time.time() - start) / num_steps
+            print('INTRA_OP_THREADS %d, INTER_OP_THREADS %d: %.2f ms/step' %
+                  (intra_op_threads, inter_op_threads, 1000 * results[(intra_op_threads, inter_op_threads)]))
+        best = min(results, key=results.get)
+        print('Fastest setting: INTRA_OP_THREADS %d, INTER_OP_THREADS %d' % best)
+        return best, results
+
     def _get_restore_meta_file(self):
         return 'part_' + str(self.flags['FILE_EPOCH']) + '.ckpt.meta'
 
@@ -319,17 +830,439 @@ class Model:
         uninit_vars_tf = [v for v in tf.global_variables() if v.name.split(':')[0] in vars_list]
         self.sess.run(tf.variables_initializer(var_list=uninit_vars_tf))
 
-    def _save_model(self, section):
-        """ Save model in the logging directory """
+    def _save_model(self, section, metric=None, higher_is_better=False):
+        """
+        Save model in the logging directory, keeping the last CHECKPOINTS_TO_KEEP checkpoints.
+        With ASYNC_CHECKPOINT, variables are copied to host memory and written by a background thread.
+        :param section: int, checkpoint number
+        :param metric: float, optional. If it is the best so far, the model is also saved as best.ckpt
+        :param higher_is_better: bool, direction of metric
+        """
         checkpoint_name = self.flags['LOGGING_DIRECTORY'] + 'part_%d' % section + '.ckpt'
+        best_name = None
+        if metric is not None:
+            if self._best_metric is None or (metric > self._best_metric if higher_is_better
+                                             else metric < self._best_metric):
+                self._best_metric = metric
+                best_name = self.flags['LOGGING_DIRECTORY'] + 'best.ckpt'
+        if self.flags['ASYNC_CHECKPOINT']:
+            if self._checkpointer is None:
+                self._checkpointer = AsyncCheckpointer(self.sess, self.saver, self.flags['CHECKPOINTS_TO_KEEP'])
+            self._checkpointer.save(checkpoint_name, best_name)
+            print("Model saving in background to file: %s" % checkpoint_name)
+            return
         save_path = self.saver.save(self.sess, checkpoint_name)
         print("Model saved in file: %s" % save_path)
-
-    def _record_training_step(self, summary):
-        """ Adds summary to writer and increments the step. """
-        self.writer.add_summary(summary=summary, global_step=self.step)
+        if best_name is not None:
+            if self._best_saver is None:
+                self._best_saver = tf.train.Saver(max_to_keep=1)
+            self._best_saver.save(self.sess, best_name, latest_filename='checkpoint_best')
+            print("Best model saved in file: %s" % best_name)
+
+    def _record_training_step(self, summary=None):
+        """ Adds summary, if any, to writer and increments the step. """
+        if summary is not None:
+            self.writer.add_summary(summary=summary, global_step=self.step)
         self.step += 1
 
+    def train(self, data=None, batch_size=None, train_op=None):
+        """
+        Generic training loop over data.next_train_batch for NUM_EPOCHS epochs, fed through _feed_dict.
+        Scalar summaries are fetched every SUMMARY_EVERY steps and histograms every HISTOGRAM_EVERY steps.
+        Checkpoints are saved every CHECKPOINT_EVERY steps (section = step), or after each epoch
+        (section = epoch) if CHECKPOINT_EVERY is None.
+        Step time is split into data wait, sess.run and summary/checkpoint IO, and reported with examples/sec
+        every DISPLAY_EVERY steps, on the terminal and as summaries.
+        Every PROFILE_EVERY steps, the step is traced and profiled by layer, see _write_profile.
+        With ASYNC_CHECKPOINT, train returns once the background checkpoint writes are done.
+        With self.accumulation_steps = K > 1 (set by _accumulate_gradients, from its num_steps or the
+        ACCUMULATION_STEPS flag), each step runs self.accumulate_op on K - 1 micro-batches and train_op on
+        the last one, see _accumulate_gradients. Steps, summaries and checkpoints count applied updates and
+        an epoch has num_train_images // (K * batch_size) of them.
+        :param data: Data instance. Defaults to self.data
+        :param batch_size: int. Defaults to flags['BATCH_SIZE']
+        :param train_op: tf.Operation. Defaults to self.optimizer
+        :return: StepTimer with the totals of the whole run
+        """
+        data = self.data if data is None else data
+        batch_size = self.flags['BATCH_SIZE'] if batch_size is None else batch_size
+        if batch_size is None:
+            raise ValueError('train needs a batch_size argument or a BATCH_SIZE flag')
+        train_op = self.optimizer if train_op is None else train_op
+        accumulation_steps = self.accumulation_steps
+        if self.flags['ACCUMULATION_STEPS'] > 1 and self.accumulate_op is None:
+            raise ValueError('ACCUMULATION_STEPS > 1 needs the optimizer built by _accumulate_gradients')
+        steps_per_epoch = data.num_train_images // (batch_size * accumulation_steps)
+        total_timer = StepTimer()
+        timer = StepTimer()
+        for epoch in range(1, self.flags['NUM_EPOCHS'] + 1):
+            for _ in range(steps_per_epoch):
+                step = self.step
+                data_time, run_time = 0.0, 0.0
+                for _ in range(accumulation_steps - 1):
+                    start = time.time()
+                    labels, images = data.next_train_batch(batch_size)
+                    data_end = time.time()
+                    self.sess.run(self.accumulate_op, feed_dict=self._feed_dict(labels, images))
+                    data_time += data_end - start
+                    run_time += time.time() - data_end
+                start = time.time()
+                labels, images = data.next_train_batch(batch_size)
+                data_end = time.time()
+                feed_dict = self._feed_dict(labels, images)
+                fetches = [train_op]
+                if self.merged_scalars is not None and step % self.flags['SUMMARY_EVERY'] == 0:
+                    fetches.append(self.merged_scalars)
+                if self.merged_histograms is not None and step % self.flags['HISTOGRAM_EVERY'] == 0:
+                    fetches.append(self.merged_histograms)
+                if self.flags['PROFILE_EVERY'] and step % self.flags['PROFILE_EVERY'] == 0:
+                    run_metadata = tf.RunMetadata()
+                    summaries = self.sess.run(fetches, feed_dict=feed_dict, run_metadata=run_metadata,
+                                              options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE))[1:]
+                else:
+                    run_metadata = None
+                    summaries = self.sess.run(fetches, feed_dict=feed_dict)[1:]
+                run_end = time.time()
+                for summary in summaries:
+                    self.writer.add_summary(summary=summary, global_step=step)
+                if run_metadata is not None:
+                    self._write_profile(run_metadata, step)
+                self._record_training_step()
+                if self.flags['CHECKPOINT_EVERY'] and step % self.flags['CHECKPOINT_EVERY'] == 0:
+                    self._save_model(section=step)
+                io_end = time.time()
+                for t in [timer, total_timer]:
+                    t.add(data_time + data_end - start, run_time + run_end - data_end, io_end - run_end,
+                          batch_size * accumulation_steps)
+                if self.flags['DISPLAY_EVERY'] and step % self.flags['DISPLAY_EVERY'] == 0:
+                    self._report_timing(timer, step, epoch)
+                    timer = StepTimer()
+            if not self.flags['CHECKPOINT_EVERY']:
+                self._save_model(section=epoch)
+        if self._checkpointer is not None:
+            self._checkpointer.wait()
+        return total_timer
+
+    def _report_timing(self, timer, step, epoch):
+        """ Prints step time averages and throughput, and writes them as summaries """
+        report = timer.report()
+        print('Epoch %d, step %d: %.1f examples/sec, %.2f ms/step (data %.2f, run %.2f, io %.2f)' %
+              (epoch, step, report['examples_per_sec'], report['step_ms'], report['data_ms'], report['run_ms'],
+               report['io_ms']))
+        values = [tf.Summary.Value(tag='timing/' + key, simple_value=value) for key, value in report.items()]
+        self.writer.add_summary(tf.Summary(value=values), global_step=step)
+        self.log_metrics(step, epoch=epoch, **report)
+
+    def _write_profile(self, run_metadata, step):
+        """
+        Aggregates the op time and output memory of a traced step by top-level Layers scope, split into forward,
+        backward (ops under a gradients/ scope) and optimizer update (update_<variable>/) time, and writes
+        profile_step_N.txt and the Chrome trace timeline_step_N.json (chrome://tracing) to the logging directory.
+        :param run_metadata: tf.RunMetadata of a sess.run with FULL_TRACE options
+        :param step: int
+        :return: dict of scope to {'forward_ms', 'backward_ms', 'update_ms', 'bytes', 'ops'}
+        """
+        from tensorflow.python.client import timeline
+        profile = dict()
+        for device in run_metadata.step_stats.dev_stats:
+            if device.device.endswith('stream:all'):  # duplicates the per-stream GPU entries
+                continue
+            for node in device.node_stats:
+                match = self.LAYER_SCOPE.search(node.node_name)
+                entry = profile.setdefault(match.group(1) if match else 'other',
+                                           {'forward_ms': 0.0, 'backward_ms': 0.0, 'update_ms': 0.0, 'bytes': 0,
+                                            'ops': 0})
+                if self.GRADIENT_OP.search(node.node_name):
+                    phase = 'backward_ms'
+                elif self.UPDATE_OP.search(node.node_name):
+                    phase = 'update_ms'
+                else:
+                    phase = 'forward_ms'
+                entry[phase] += (node.all_end_rel_micros - node.op_start_rel_micros) / 1000
+                entry['bytes'] += sum(output.tensor_description.allocation_description.requested_bytes
+                                      for output in node.output)
+                entry['ops'] += 1
+
+        def op_ms(e):
+            return e['forward_ms'] + e['backward_ms'] + e['update_ms']
+        total_ms = max(sum(op_ms(e) for e in profile.values()), 1e-6)
+        lines = ['Step %d profile, %.2f ms of op time' % (step, total_ms),
+                 '%-16s %12s %12s %12s %8s %12s %6s' % ('scope', 'forward ms', 'backward ms', 'update ms', '%',
+                                                        'output MB', 'ops')]
+        for scope, e in sorted(profile.items(), key=lambda item: -op_ms(item[1])):
+            lines.append('%-16s %12.3f %12.3f %12.3f %8.1f %12.2f %6d' % (
+                scope, e['forward_ms'], e['backward_ms'], e['update_ms'], 100 * op_ms(e) / total_ms,
+                e['bytes'] / 2 ** 20, e['ops']))
+        table_file = os.path.join(self.flags['LOGGING_DIRECTORY'], 'profile_step_%d.txt' % step)
+        with open(table_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        trace_file = os.path.join(self.flags['LOGGING_DIRECTORY'], 'timeline_step_%d.json' % step)
+        with open(trace_file, 'w') as f:
+            f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format(show_memory=True))
+        self.print_log('\n'.join(lines), level=2)
+        self.print_log('Profile written to %s and %s' % (table_file, trace_file))
+        return profile
+
+    def summary(self, layers, memory_budget=None):
+        """
+        Prints the layer table of layers (see Layers.summary) with a memory estimate of the train step:
+        all variables of the graph (weights, moving averages, optimizer slots, and local variables such as the
+        gradient accumulators of _accumulate_gradients), one gradient per trainable variable and the forward
+        activations of the batch, which are kept for the backward pass.
+        :param layers: Layers instance that built the network, with stats=True
+        :param memory_budget: int, bytes, e.g. the memory of the GPU. If given, the largest batch size that fits
+        :return: dict of totals, see Layers.summary, with 'train_step_bytes' for flags['BATCH_SIZE'] if set
+        """
+        def variable_bytes(variables):
+            return sum(Layers.num_elements(v.get_shape()) * v.dtype.base_dtype.size for v in variables)
+        layer_variable_bytes = sum(stats['variable_bytes'] for stats in layers.layer_stats)
+        fixed_bytes = variable_bytes(tf.global_variables()) + variable_bytes(tf.local_variables()) - \
+            layer_variable_bytes + variable_bytes(tf.trainable_variables())
+        totals = layers.summary(memory_budget, fixed_bytes)
+        totals['fixed_bytes'] = fixed_bytes + layer_variable_bytes
+        if self.flags.get('BATCH_SIZE'):
+            totals['train_step_bytes'] = totals['fixed_bytes'] + self.flags['BATCH_SIZE'] * totals['activation_bytes']
+            self.print_log('Estimated train step memory at batch size %d: %.2f MB (%.2f MB of variables and gradients)'
+                           % (self.flags['BATCH_SIZE'], totals['train_step_bytes'] / 2 ** 20,
+                              totals['fixed_bytes'] / 2 ** 20))
+        return totals
+
+    def _feed_dict(self, labels, images):
+        """Map a batch to the feed_dict of the network. Needed by train."""
+        raise NotImplementedError
+
+    def evaluate(self, data, metric, feed_fn, batch_size, split='valid', pad=False):
+        """
+        Averages a per-example metric over a whole split with one sess.run per batch.
+        Sums are accumulated in local variables on the graph side and masked examples are ignored.
+        :param data: Data instance
+        :param metric: tf.Tensor, per-example values of shape [batch], e.g. correct predictions or losses
+        :param feed_fn: function (labels, images) -> feed_dict
+        :param batch_size: int
+        :param split: string, 'train', 'valid' or 'test'
+        :param pad: bool, see Data.eval_batches
+        :return: float, mean of metric over the split
+        """
+        mask, update_op, reset_op, mean = self._get_eval_ops(metric)
+        self.sess.run(reset_op)
+        for labels, images, batch_mask in data.eval_batches(batch_size, split, pad):
+            feed_dict = feed_fn(labels, images)
+            feed_dict[mask] = batch_mask
+            self.sess.run(update_op, feed_dict=feed_dict)
+        return self.sess.run(mean)
+
+    def _get_eval_ops(self, metric):
+        """ Builds, once per metric, the mask placeholder and the accumulate, reset and mean ops for evaluate """
+        if metric.name not in self._eval_metric_ops:
+            with tf.name_scope('evaluation'):
+                mask = tf.placeholder(tf.bool, [None], name='mask')
+                total = tf.Variable(0.0, dtype=tf.float64, trainable=False, name='total',
+                                    collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                count = tf.Variable(0.0, dtype=tf.float64, trainable=False, name='count',
+                                    collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                values = tf.boolean_mask(tf.cast(metric, tf.float64), mask)
+                update_op = tf.group(tf.assign_add(total, tf.reduce_sum(values)),
+                                     tf.assign_add(count, tf.cast(tf.size(values), tf.float64)))
+                reset_op = tf.variables_initializer([total, count])
+                mean = total / tf.maximum(count, 1.0)
+            self._eval_metric_ops[metric.name] = (mask, update_op, reset_op, mean)
+        return self._eval_metric_ops[metric.name]
+
+    def export_inference_graph(self, output_node_names, checkpoint=None, filename='inference_graph.pb'):
+        """
+        Writes a frozen, constant-folded GraphDef for serving to the logging directory. _network() is rebuilt in a
+        new graph with the trained values as constants: batch normalization (moving averages), bias and scale are
+        folded into the conv2d/deconv2d/fc weights, dropout is skipped, and the weight_losses, optimizer and
+        summaries are never built. Placeholders that _data() stored as attributes are recreated with the same names.
+        :param output_node_names: list of strings, output op names in the rebuilt graph (e.g. ['fc_3/Softmax'])
+        :param checkpoint: string, optional checkpoint to restore first (e.g. LOGGING_DIRECTORY + 'best.ckpt')
+        :param filename: string
+        :return: string, path of the written GraphDef
+        """
+        graph, sess = self._frozen_network(self._frozen_values(checkpoint))
+        path, graph_def = self._write_frozen_graph(graph, sess, output_node_names, filename)
+        self.print_log('Inference graph with %d nodes written to %s' % (len(graph_def.node), path))
+        return path
+
+    def export_quantized_graph(self, output_node_names, data, feed_fn, batch_size, num_batches=10, split='valid',
+                               checkpoint=None, filename='quantized_graph.pb'):
+        """
+        Post-training eight-bit quantization of the graph written by export_inference_graph.
+        The input range of every conv2d, fc and res_layer convolution is calibrated on num_batches training batches,
+        their folded weights are stored as quint8 and they run as QuantizedConv2D/QuantizedMatMul.
+        Everything else (bias, activations, pooling, deconv2d) stays float32.
+        Both graphs are then evaluated on split and the comparison is printed and logged.
+        :param output_node_names: list of strings, output op names in the rebuilt graph. The first one is compared
+        :param data: Data instance
+        :param feed_fn: function of (labels, images), returning a feed dict of the training graph
+        :param batch_size: int
+        :param num_batches: int, number of calibration batches
+        :param split: string, Data split to compare the float and quantized graphs on
+        :param checkpoint: string, optional checkpoint to restore first
+        :param filename: string
+        :return: string, path of the written GraphDef, and dict, the comparison report
+        """
+        frozen_values = self._frozen_values(checkpoint)
+
+        # Calibrate: record the input of each quantizable layer in the float graph and track its range
+        Layers.calibration_inputs = dict()
+        try:
+            graph, sess = self._frozen_network(frozen_values)
+            inputs = Layers.calibration_inputs
+        finally:
+            Layers.calibration_inputs = None
+        ranges = {scope: [0.0, 0.0] for scope in inputs}  # ranges always include 0, the value of zero padding
+        for i, (labels, images, _) in enumerate(data.eval_batches(batch_size, split='train')):
+            if i == num_batches:
+                break
+            values = sess.run(inputs, feed_dict=self._translate_feed(graph, feed_fn(labels, images)))
+            for scope, value in values.items():
+                ranges[scope] = [min(ranges[scope][0], float(value.min())), max(ranges[scope][1], float(value.max()))]
+        _, float_graph_def = self._write_frozen_graph(graph, sess, output_node_names, None)
+
+        Layers.quantize_ranges = ranges
+        try:
+            graph, sess = self._frozen_network(frozen_values)
+        finally:
+            Layers.quantize_ranges = None
+        path, graph_def = self._write_frozen_graph(graph, sess, output_node_names, filename)
+
+        report = self._compare_graphs(float_graph_def, graph_def, output_node_names[0], data, feed_fn, batch_size,
+                                      split)
+        report['float_bytes'] = float_graph_def.ByteSize()
+        report['quantized_bytes'] = graph_def.ByteSize()
+        self.print_log('Quantized graph with %d quantized layers written to %s' % (len(ranges), path))
+        self.print_log(', '.join('%s %.4g' % (key, value) for key, value in report.items()))
+        self.log_metrics(**report)
+        return path, report
+
+    def _frozen_values(self, checkpoint=None):
+        """ Returns a dict of variable op name to trained value, read from checkpoint if given (self.sess is left
+        untouched, so exporting during training does not rewind it), or else from self.sess """
+        variables = tf.global_variables()
+        if checkpoint is not None:
+            reader = tf.train.NewCheckpointReader(checkpoint)
+            return {v.op.name: reader.get_tensor(v.op.name) for v in variables if reader.has_tensor(v.op.name)}
+        return {v.op.name: value for v, value in zip(variables, self.sess.run(variables))}
+
+    def _frozen_network(self, frozen_values):
+        """
+        Rebuilds _network() in a new graph with Layers in frozen mode, without touching the training graph or the
+        attributes _network() sets. Placeholder attributes (usually created in _data()) are first replaced by
+        placeholders of the same name, dtype and shape in the new graph.
+        :return: the graph, and a session on it in which variables created outside of Layers hold their values
+        """
+        state = dict(self.__dict__)
+        graph = tf.Graph()
+        Layers.frozen_values = frozen_values
+        try:
+            with graph.as_default():
+                copies = dict()
+                for key, value in state.items():
+                    if isinstance(value, tf.Tensor) and value.op.type == 'Placeholder':
+                        if value.name not in copies:
+                            copies[value.name] = tf.placeholder(value.dtype, value.get_shape(), name=value.op.name)
+                        setattr(self, key, copies[value.name])
+                self._network()
+        finally:
+            Layers.frozen_values = None
+            self.__dict__.clear()
+            self.__dict__.update(state)
+        sess = tf.Session(graph=graph)
+        for var in graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES):
+            var.load(frozen_values[var.op.name], sess)
+        return graph, sess
+
+    def _write_frozen_graph(self, graph, sess, output_node_names, filename):
+        """
+        Freezes the remaining variables, strips training nodes and folds constants. Closes sess.
+        :param filename: string, name in the logging directory, or None to only return the GraphDef
+        :return: path (or None), GraphDef
+        """
+        with sess:
+            graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), output_node_names)
+        graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=output_node_names)
+
+        from tensorflow.tools.graph_transforms import TransformGraph
+        input_names = [node.name for node in graph_def.node if node.op == 'Placeholder']
+        graph_def = TransformGraph(graph_def, input_names, output_node_names,
+                                   ['strip_unused_nodes', 'fold_constants(ignore_errors=true)', 'fold_batch_norms',
+                                    'sort_by_execution_order'])
+        if filename is None:
+            return None, graph_def
+        return tf.train.write_graph(graph_def, self.flags['LOGGING_DIRECTORY'], filename, as_text=False), graph_def
+
+    def _compare_graphs(self, float_graph_def, graph_def, output_node_name, data, feed_fn, batch_size, split):
+        """
+        Runs two exported graphs on a Data split and compares their output.
+        :return: dict with the mean and max absolute difference, and for [batch, classes] outputs the top-1
+            agreement and both accuracies against the labels
+        """
+        sessions = list()
+        for gd in [float_graph_def, graph_def]:
+            graph = tf.Graph()
+            with graph.as_default():
+                tf.import_graph_def(gd, name='')
+            sessions.append(tf.Session(graph=graph))
+        errors, agreements, float_correct, quantized_correct = list(), list(), list(), list()
+        try:
+            for labels, images, mask in data.eval_batches(batch_size, split=split, pad=True):
+                float_out, quantized_out = [
+                    sess.run(output_node_name + ':0',
+                             feed_dict=self._translate_feed(sess.graph, feed_fn(labels, images)))[mask]
+                    for sess in sessions]
+                errors.append(np.abs(float_out - quantized_out).reshape(len(float_out), -1))
+                if float_out.ndim == 2:
+                    truth = np.argmax(labels, axis=1) if labels.ndim == 2 else labels
+                    truth = truth[mask]
+                    agreements.append(np.argmax(float_out, axis=1) == np.argmax(quantized_out, axis=1))
+                    float_correct.append(np.argmax(float_out, axis=1) == truth)
+                    quantized_correct.append(np.argmax(quantized_out, axis=1) == truth)
+        finally:
+            for sess in sessions:
+                sess.close()
+        errors = np.concatenate(errors)
+        report = {'mean_abs_error': float(errors.mean()), 'max_abs_error': float(errors.max())}
+        if agreements:
+            report['top1_agreement'] = float(np.concatenate(agreements).mean())
+            report['float_accuracy'] = float(np.concatenate(float_correct).mean())
+            report['quantized_accuracy'] = float(np.concatenate(quantized_correct).mean())
+        return report
+
+    @staticmethod
+    def _translate_feed(graph, feed_dict):
+        """
+        Maps a feed dict of the training graph onto the tensors of the same name in graph. Feeds graph does not have
+        are dropped, as exported graphs strip placeholders they no longer use (e.g. labels, dropout keep probabilities)
+        """
+        feed = dict()
+        for key, value in feed_dict.items():
+            name = key if isinstance(key, str) else key.name
+            try:
+                feed[graph.get_tensor_by_name(name)] = value
+            except KeyError:
+                pass
+        return feed
+
+    def close(self):
+        """ Stops background workers of any Data attributes, finishes pending checkpoints, then flushes the writer
+        and closes the session. """
+        if self._checkpointer is not None:
+            self._checkpointer.close()
+            self._checkpointer = None
+        for attr in list(vars(self).values()):
+            if isinstance(attr, Data):
+                attr.stop_prefetch()
+        self.writer.close()
+        self.sess.close()
+        if sys.stdout is self.logger:
+            sys.stdout = self.logger.terminal
+        self.logger.close()
+
+    def log_metrics(self, step=None, **metrics):
+        """ Writes a structured record of metrics to ModelInformation.jsonl """
+        self.logger.log_metrics(self.step if step is None else step, **metrics)
+
     def _set_seed(self):
         """ Set random seed for numpy and tensorflow packages """
         if self.flags['SEED'] is not None:
@@ -337,10 +1270,18 @@ class Model:
             np.random.seed(self.flags['SEED'])
 
     def _summaries(self):
-        """ Print out summaries for every variable. Can be overriden in main function. """
+        """ Print out summaries for every variable. Can be overriden in main function.
+        Histograms go to HISTOGRAM_SUMMARIES; scalar summaries belong in the default collection. """
         for var in tf.trainable_variables():
-            tf.summary.histogram(var.name, var)
-            print(var.name)
+            tf.summary.histogram(var.name, var, collections=[self.HISTOGRAM_SUMMARIES])
+            self.print_log(var.name, level=2)
+
+    def _merge_summary_tiers(self):
+        """
+        Merges summaries by cost. self.merged still holds both tiers.
+        :return: merged_scalars (default summary collection), merged_histograms (HISTOGRAM_SUMMARIES), or None
+        """
+        return tf.summary.merge_all(), tf.summary.merge_all(key=self.HISTOGRAM_SUMMARIES)
 
     def _data(self):
         """Define data"""
@@ -354,6 +1295,54 @@ class Model:
         """Define optimizer"""
         raise NotImplementedError
 
+    def _accumulate_gradients(self, optimizer, loss, num_steps=None, weight_decay=None, var_list=None,
+                              global_step=None):
+        """
+        Gradient accumulation, for an effective batch of num_steps micro-batches. Call it in _optimizer instead of
+        optimizer.minimize: self.optimizer = self._accumulate_gradients(tf.train.AdamOptimizer(lr), self.cost)
+        Sets self.accumulate_op, which adds the gradients of a micro-batch to accumulators (local variables, so
+        not checkpointed). The returned op adds those of the last micro-batch, applies the average and resets
+        the accumulators. Sets self.accumulation_steps to num_steps, so train runs it every num_steps micro-batches.
+        :param optimizer: tf.train.Optimizer
+        :param loss: tensor, loss of one micro-batch without weight decay
+        :param num_steps: int, micro-batches per update. Defaults to flags['ACCUMULATION_STEPS']
+        :param weight_decay: float, optional. The gradient of weight_decay * sum of the 'weight_losses' collection
+            is added once per update, as the weights do not change between micro-batches
+        :param var_list: list of variables to train. Defaults to the trainable variables
+        :param global_step: variable, optional, incremented once per update
+        :return: tf.Operation, the update
+        """
+        num_steps = self.flags['ACCUMULATION_STEPS'] if num_steps is None else num_steps
+        grads_and_vars = [(g, v) for g, v in optimizer.compute_gradients(loss, var_list) if g is not None]
+        if weight_decay is not None:
+            decay = weight_decay * tf.add_n(tf.get_collection('weight_losses'))
+            decay_grads = tf.gradients(decay, [v for _, v in grads_and_vars])
+        else:
+            decay_grads = [None] * len(grads_and_vars)
+
+        accumulate_ops, update_grads_and_vars, accumulators = list(), list(), list()
+        with tf.name_scope('gradient_accumulation'):
+            for (g, v), decay_grad in zip(grads_and_vars, decay_grads):
+                with tf.colocate_with(v):
+                    accumulator = tf.Variable(tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype), trainable=False,
+                                              collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                                              name=v.op.name.replace('/', '_'))
+                if isinstance(g, tf.IndexedSlices):
+                    accumulate_ops.append(tf.scatter_add(accumulator, g.indices, g.values))
+                    g = tf.convert_to_tensor(g)
+                else:
+                    accumulate_ops.append(tf.assign_add(accumulator, g))
+                update = (accumulator + g) / num_steps
+                if decay_grad is not None:
+                    update += tf.convert_to_tensor(decay_grad)
+                update_grads_and_vars.append((update, v))
+                accumulators.append(accumulator)
+            self.accumulate_op = tf.group(*accumulate_ops, name='accumulate')
+        self.accumulation_steps = num_steps
+        apply_op = optimizer.apply_gradients(update_grads_and_vars, global_step=global_step)
+        with tf.control_dependencies([apply_op]):
+            return tf.group(*[tf.assign(a, tf.zeros_like(a)) for a in accumulators], name='apply_accumulated')
+
     def get_flags(self):
         return self.flags
 
@@ -364,9 +1353,10 @@ class Model:
             os.makedirs(folder_path)
 
     @staticmethod
-    def print_log(message):
-        """ Print message to terminal and to logging document if applicable """
-        print(message)
+    def print_log(message, level=1):
+        """ Print message to terminal, if level is within the verbosity, and to logging document if applicable """
+        if level <= _verbosity:
+            print(message)
         logging.info(message)
 
     @staticmethod
@@ -388,7 +1378,7 @@ class Model:
     @staticmethod
     def get_variables_in_checkpoint_file(filename):
         try:
-            reader = pywrap_tensorflow.NewCheckpointReader(filename)
+            reader = tf.train.NewCheckpointReader(filename)
             var_to_shape_map = reader.get_variable_to_shape_map()
             return var_to_shape_map
         except Exception as e:  # pylint: disable=broad-except
@@ -449,20 +1439,208 @@ class Model:
         return self._merge_a_into_b(yaml_cfg, config_dict)
 
 
+class StepTimer:
+    """ Accumulates the wall time of training steps, split into data wait, sess.run and IO """
+
+    def __init__(self):
+        self.steps = 0
+        self.examples = 0
+        self.data_time = 0.0
+        self.run_time = 0.0
+        self.io_time = 0.0
+
+    def add(self, data_time, run_time, io_time, examples):
+        self.steps += 1
+        self.examples += examples
+        self.data_time += data_time
+        self.run_time += run_time
+        self.io_time += io_time
+
+    def report(self):
+        """ Returns a dict of average milliseconds per step for each phase, and examples per second """
+        steps = max(self.steps, 1)
+        total_time = self.data_time + self.run_time + self.io_time
+        return {'examples_per_sec': self.examples / total_time if total_time > 0 else 0.0,
+                'step_ms': 1000 * total_time / steps,
+                'data_ms': 1000 * self.data_time / steps,
+                'run_ms': 1000 * self.run_time / steps,
+                'io_ms': 1000 * self.io_time / steps}
+
+
+class AsyncCheckpointer:
+    """
+    Writes checkpoints from a background thread so that training only waits for a copy of the variables.
+    A shadow graph holds one variable per saved variable. The worker loads the copied values into it and
+    saves it under the original names, with the meta graph of the model, so the files restore like saver's.
+    Queued checkpoints are written out at exit if close is not called before.
+    """
+
+    def __init__(self, sess, saver, max_to_keep=5):
+        """
+        :param sess: tf.Session of the model
+        :param saver: tf.train.Saver of the model, whose meta graph is written with each checkpoint
+        :param max_to_keep: int, number of recent checkpoints to keep
+        """
+        self.sess = sess
+        self.saver_def = saver.saver_def
+        self.var_list = tf.global_variables()
+        self._meta_graph = None
+        self._graph_version = None
+        self._error = None
+        self._closed = False
+
+        self._shadow_graph = tf.Graph()
+        with self._shadow_graph.as_default():
+            self._placeholders = list()
+            shadow_vars = dict()
+            for var in self.var_list:
+                placeholder = tf.placeholder(var.dtype.base_dtype, var.get_shape())
+                self._placeholders.append(placeholder)
+                shadow_vars[var.op.name] = tf.Variable(placeholder, trainable=False, collections=[])
+            self._load_op = tf.group(*[v.initializer for v in shadow_vars.values()])
+            self._saver = tf.train.Saver(shadow_vars, max_to_keep=max_to_keep)
+            self._best_saver = tf.train.Saver(shadow_vars, max_to_keep=1)
+        self._shadow_sess = tf.Session(graph=self._shadow_graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._worker, name='tensorbase-checkpoint', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def save(self, checkpoint_name, best_name=None):
+        """
+        Copies the variables and queues them for writing. Blocks only if the previous checkpoint is still queued.
+        :param checkpoint_name: string, checkpoint path
+        :param best_name: string, optional second path written with a separate max_to_keep=1 saver
+        """
+        self._check_error()
+        graph = self.sess.graph
+        if self._graph_version != graph.version:  # meta graph is only re-exported when the graph changes
+            self._meta_graph = tf.train.export_meta_graph(saver_def=self.saver_def).SerializeToString()
+            self._graph_version = graph.version
+        values = self.sess.run(self.var_list)
+        self._queue.put((checkpoint_name, best_name, values, self._meta_graph))
+
+    def wait(self):
+        """ Blocks until every queued checkpoint is written """
+        self._queue.join()
+        self._check_error()
+
+    def close(self):
+        """ Waits for queued checkpoints to be written and stops the worker. Called at exit if not called before. """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._shadow_sess.close()
+        atexit.unregister(self.close)
+        self._check_error()
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            checkpoint_name, best_name, values, meta_graph = item
+            try:
+                self._shadow_sess.run(self._load_op, feed_dict=dict(zip(self._placeholders, values)))
+                self._write(self._saver, checkpoint_name, meta_graph, 'checkpoint')
+                if best_name is not None:
+                    self._write(self._best_saver, best_name, meta_graph, 'checkpoint_best')
+            except Exception as e:  # pylint: disable=broad-except
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, saver, checkpoint_name, meta_graph, latest_filename):
+        save_path = saver.save(self._shadow_sess, checkpoint_name, latest_filename=latest_filename,
+                               write_meta_graph=False)
+        with open(save_path + '.meta', 'wb') as f:
+            f.write(meta_graph)
+        print("Model saved in file: %s" % save_path)
+
+
 class Logger(object):
-    def __init__(self, filename):
+    """
+    Tees sys.stdout to a log file. Terminal writes stay synchronous. File writes go through a bounded buffer
+    drained by a background thread, which flushes every flush_interval seconds, on flush() and at exit.
+    log_metrics appends JSON lines records to a .jsonl file next to the text log.
+    """
+    _FLUSH = object()
+
+    def __init__(self, filename, max_buffer=10000, flush_interval=5.0):
+        """
+        :param filename: string, text log, opened for appending
+        :param max_buffer: int, maximum number of pending writes before write() blocks
+        :param flush_interval: float, seconds between file flushes
+        """
         self.terminal = sys.stdout
         self.log = open(filename, "a")
+        self.metrics_log = open(os.path.splitext(filename)[0] + '.jsonl', "a")
+        self.flush_interval = flush_interval
+        self._closed = False
+        self._queue = queue.Queue(maxsize=max_buffer)
+        self._thread = threading.Thread(target=self._worker, name='tensorbase-logger', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
 
     def write(self, message):
         self.terminal.write(message)
-        self.log.write(message)
+        if not self._closed:
+            self._queue.put((self.log, message))
+
+    def log_metrics(self, step, **metrics):
+        """ Queues one JSON record with the step, a timestamp and the given metrics """
+        record = dict(metrics, step=step, time=time.time())
+        if not self._closed:
+            self._queue.put((self.metrics_log, json.dumps(record) + '\n'))
 
     def flush(self):
-        #this flush method is needed for python 3 compatibility.
-        #this handles the flush command by doing nothing.
-        #you might want to specify some extra behavior here.
-        pass
+        """ Flushes the terminal and asks the writer thread to flush the files, without waiting for it """
+        self.terminal.flush()
+        if not self._closed:
+            self._queue.put(self._FLUSH)
+
+    def close(self):
+        """ Writes out the buffer and closes the files. Called at exit if not called before. """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self.log.close()
+        self.metrics_log.close()
+        atexit.unregister(self.close)
+
+    def _worker(self):
+        last_flush = time.time()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = self._FLUSH
+            if item is not None and item is not self._FLUSH:
+                log, message = item
+                log.write(message)
+            if item is None or item is self._FLUSH or time.time() - last_flush >= self.flush_interval:
+                self.log.flush()
+                self.metrics_log.flush()
+                last_flush = time.time()
+            if item is None:
+                return
+
+    def __getattr__(self, name):
+        # Delegate the rest of the file interface (encoding, isatty, fileno) to the terminal
+        if name == 'terminal':
+            raise AttributeError(name)
+        return getattr(self.terminal, name)
 
 
 class Layers:
@@ -471,16 +1649,44 @@ class Layers:
     Methods: conv2d, deconv2d, cflatten, maxpool, avgpool, res_layer, noisy_and, batch_norm
     """
 
-    def __init__(self, x):
+    # Variable name -> trained value, set by Model.export_inference_graph while it rebuilds the network.
+    # Layers then emit constants instead of variables, fold bn/bias/scale into weights and skip dropout.
+    frozen_values = None
+    # Set by Model.export_quantized_graph in frozen mode: a dict that collects the input tensor of every
+    # quantizable convolution and matmul by variable scope, then a dict of their calibrated (min, max) ranges
+    calibration_inputs = None
+    quantize_ranges = None
+    # True while res_layer(recompute=True) rebuilds a block for its gradient, see recomputable
+    _recomputing = False
+
+    def __init__(self, x, training=None, fused=False, stats=False):
         """
         Initialize model Layers.
         .input = numpy array
         .count = dictionary to keep count of number of certain types of layers for naming purposes
+        .training = None to always normalize with batch moments (no extra variables), or a bool or bool tensor
+            to track moving averages: batch moments and updates when True, moving averages when False.
+            A tf.placeholder_with_default(True, []) lets a restored model be served with batch size 1.
+        .fused = True to run batch normalization, bias and scale of conv2d, deconv2d and fc as a single
+            fused_batch_norm op. Variables keep the same names, so checkpoints restore either way.
+        .stats = True to record parameters, FLOPs and activation memory of every layer for summary
         """
         self.input = x  # initialize input tensor
         self.count = {'conv': 0, 'deconv': 0, 'fc': 0, 'flat': 0, 'mp': 0, 'up': 0, 'ap': 0, 'rn': 0}
-
-    def conv2d(self, filter_size, output_channels, stride=1, padding='SAME', bn=True, activation_fn=tf.nn.relu,
+        self.training = training
+        self.fused = fused
+        self.stats = stats
+
+        # Per layer parameters, FLOPs and activation memory, see log_layer and summary
+        self.layer_stats = list()
+        self._batch_dim = x.get_shape()[0].value if x.get_shape().ndims else None
+        self._flops = 0
+        if stats:
+            self._num_variables = len(tf.get_collection_ref(tf.GraphKeys.GLOBAL_VARIABLES))
+            self._num_trainable = len(tf.get_collection_ref(tf.GraphKeys.TRAINABLE_VARIABLES))
+            self._num_ops = len(tf.get_default_graph().get_operations())
+
+    def conv2d(self, filter_size, output_channels, stride=1, padding='SAME', bn=True, activation_fn=relu,
                b_value=0.0, s_value=1.0, trainable=True):
         """
         2D Convolutional Layer.
@@ -503,19 +1709,27 @@ class Layers:
                 padding = 'VALID'
             output_shape = [filter_size, filter_size, input_channels, output_channels]
             w = self.weight_variable(name='weights', shape=output_shape, trainable=trainable)
-            self.input = tf.nn.conv2d(self.input, w, strides=[1, stride, stride, 1], padding=padding)
-
-            if bn is True:  # batch normalization
-                self.input = self.batch_norm(self.input)
-            if b_value is not None:  # bias value
-                b = self.const_variable(name='bias', shape=[output_channels], value=b_value, trainable=trainable)
-                self.input = tf.add(self.input, b)
-            if s_value is not None:  # scale value
-                s = self.const_variable(name='scale', shape=[output_channels], value=s_value, trainable=trainable)
-                self.input = tf.multiply(self.input, s)
+            folded = self.folded_parameters(3, bn, b_value, s_value)
+            if folded is not None:  # frozen inference graph, see Model.export_inference_graph
+                w, b = folded
+            self.input = self.quantizable_conv2d(self.input, w, strides=[1, stride, stride, 1], padding=padding)
+
+            if folded is not None:  # bn, bias and scale are folded into w and b
+                self.input = tf.nn.bias_add(self.input, b)
+            elif bn is True and self.fused:  # batch normalization, bias and scale in one kernel
+                self.input = self.fused_batch_norm(self.input, output_channels, b_value, s_value, trainable, 'conv')
+            else:
+                if bn is True:  # batch normalization
+                    self.input = self.batch_norm(self.input)
+                if b_value is not None:  # bias value
+                    b = self.const_variable(name='bias', shape=[output_channels], value=b_value, trainable=trainable)
+                    self.input = tf.add(self.input, b)
+                if s_value is not None:  # scale value
+                    s = self.const_variable(name='scale', shape=[output_channels], value=s_value, trainable=trainable)
+                    self.input = tf.multiply(self.input, s)
             if activation_fn is not None:  # activation function
                 self.input = activation_fn(self.input)
-        print(scope + ' output: ' + str(self.input.get_shape()))
+        self.log_layer(scope)
 
     def convnet(self, filter_size, output_channels, stride=None, padding=None, activation_fn=None, b_value=None,
                 s_value=None, bn=None, trainable=True):
@@ -568,7 +1782,7 @@ class Layers:
                         s_value=s_value[l],
                         bn=bn[l], trainable=trainable)
 
-    def deconv2d(self, filter_size, output_channels, stride=1, padding='SAME', activation_fn=tf.nn.relu, b_value=0.0,
+    def deconv2d(self, filter_size, output_channels, stride=1, padding='SAME', activation_fn=relu, b_value=0.0,
                  s_value=1.0, bn=True, trainable=True):
         """
         2D Deconvolutional Layer
@@ -600,20 +1814,37 @@ class Layers:
             input_channels = self.input.get_shape()[3]
             output_shape = [filter_size, filter_size, output_channels, input_channels]
             w = self.weight_variable(name='weights', shape=output_shape, trainable=trainable)
+            folded = self.folded_parameters(2, bn, b_value, s_value)
+            if folded is not None:  # frozen inference graph, see Model.export_inference_graph
+                w, b = folded
             deconv_out_shape = tf.stack([batch_size, out_rows, out_cols, output_channels])
+            self._flops += 2 * self.num_elements(self.input.get_shape()[1:3]) * self.num_elements(w.get_shape())
+            static_rows, static_cols = self.input.get_shape()[1].value, self.input.get_shape()[2].value
             self.input = tf.nn.conv2d_transpose(self.input, w, deconv_out_shape, [1, stride, stride, 1], padding)
+            if static_rows is not None and static_cols is not None:  # same arithmetic as the dynamic shape
+                if padding == "VALID":
+                    static_rows, static_cols = (static_rows - 1) * stride + filter_size, \
+                                               (static_cols - 1) * stride + filter_size
+                else:
+                    static_rows, static_cols = static_rows * stride, static_cols * stride
+            self.input.set_shape([None, static_rows, static_cols, output_channels])
 
-            if bn is True:  # batch normalization
-                self.input = self.batch_norm(self.input)
-            if b_value is not None:  # bias value
-                b = self.const_variable(name='bias', shape=[output_channels], value=b_value, trainable=trainable)
-                self.input = tf.add(self.input, b)
-            if s_value is not None:  # scale value
-                s = self.const_variable(name='scale', shape=[output_channels], value=s_value, trainable=trainable)
-                self.input = tf.multiply(self.input, s)
+            if folded is not None:  # bn, bias and scale are folded into w and b
+                self.input = tf.nn.bias_add(self.input, b)
+            elif bn is True and self.fused:  # batch normalization, bias and scale in one kernel
+                self.input = self.fused_batch_norm(self.input, output_channels, b_value, s_value, trainable, 'conv')
+            else:
+                if bn is True:  # batch normalization
+                    self.input = self.batch_norm(self.input)
+                if b_value is not None:  # bias value
+                    b = self.const_variable(name='bias', shape=[output_channels], value=b_value, trainable=trainable)
+                    self.input = tf.add(self.input, b)
+                if s_value is not None:  # scale value
+                    s = self.const_variable(name='scale', shape=[output_channels], value=s_value, trainable=trainable)
+                    self.input = tf.multiply(self.input, s)
             if activation_fn is not None:  # non-linear activation function
                 self.input = activation_fn(self.input)
-        print(scope + ' output: ' + str(self.input.get_shape()))  # print shape of output
+        self.log_layer(scope)  # print shape of output
 
     def deconvnet(self, filter_sizes, output_channels, strides=None, padding=None, activation_fn=None, b_value=None,
                   s_value=None, bn=None, trainable=True):
@@ -676,11 +1907,11 @@ class Layers:
             self.input = tf.reshape(self.input, output_shape)
 
             # Dropout function
-            if keep_prob != 1:
+            if keep_prob != 1 and Layers.frozen_values is None:
                 self.input = tf.nn.dropout(self.input, keep_prob=keep_prob)
-        print(scope + ' output: ' + str(self.input.get_shape()))
+        self.log_layer(scope)
 
-    def fc(self, output_nodes, keep_prob=1, activation_fn=tf.nn.relu, b_value=0.0, s_value=1.0, bn=True,
+    def fc(self, output_nodes, keep_prob=1, activation_fn=relu, b_value=0.0, s_value=1.0, bn=True,
            trainable=True):
         """
         Fully Connected Layer
@@ -706,21 +1937,29 @@ class Layers:
             input_nodes = self.input.get_shape()[1]
             output_shape = [input_nodes, output_nodes]
             w = self.weight_variable(name='weights', shape=output_shape, trainable=trainable)
-            self.input = tf.matmul(self.input, w)
-
-            if bn is True:  # batch normalization
-                self.input = self.batch_norm(self.input, 'fc')
-            if b_value is not None:  # bias value
-                b = self.const_variable(name='bias', shape=[output_nodes], value=b_value, trainable=trainable)
-                self.input = tf.add(self.input, b)
-            if s_value is not None:  # scale value
-                s = self.const_variable(name='scale', shape=[output_nodes], value=s_value, trainable=trainable)
-                self.input = tf.multiply(self.input, s)
+            folded = self.folded_parameters(1, bn, b_value, s_value)
+            if folded is not None:  # frozen inference graph, see Model.export_inference_graph
+                w, b = folded
+            self.input = self.quantizable_matmul(self.input, w)
+
+            if folded is not None:  # bn, bias and scale are folded into w and b
+                self.input = tf.nn.bias_add(self.input, b)
+            elif bn is True and self.fused:  # batch normalization, bias and scale in one kernel
+                self.input = self.fused_batch_norm(self.input, output_nodes, b_value, s_value, trainable, 'fc')
+            else:
+                if bn is True:  # batch normalization
+                    self.input = self.batch_norm(self.input, 'fc')
+                if b_value is not None:  # bias value
+                    b = self.const_variable(name='bias', shape=[output_nodes], value=b_value, trainable=trainable)
+                    self.input = tf.add(self.input, b)
+                if s_value is not None:  # scale value
+                    s = self.const_variable(name='scale', shape=[output_nodes], value=s_value, trainable=trainable)
+                    self.input = tf.multiply(self.input, s)
             if activation_fn is not None:  # activation function
                 self.input = activation_fn(self.input)
-            if keep_prob != 1:  # dropout function
+            if keep_prob != 1 and Layers.frozen_values is None:  # dropout function, not in frozen graphs
                 self.input = tf.nn.dropout(self.input, keep_prob=keep_prob)
-        print(scope + ' output: ' + str(self.input.get_shape()))
+        self.log_layer(scope)
 
     def maxpool(self, k=2, s=None, globe=False):
         """
@@ -749,7 +1988,8 @@ class Layers:
                 padding = 'SAME'
             # Max Pool Function
             self.input = tf.nn.max_pool(self.input, ksize=[1, k1, k2, 1], strides=[1, s1, s2, 1], padding=padding)
-        print(scope + ' output: ' + str(self.input.get_shape()))
+            self._flops += self.num_elements(self.input.get_shape()[1:]) * int(k1) * int(k2)
+        self.log_layer(scope)
 
     def avgpool(self, k=2, s=None, globe=False):
         """
@@ -778,10 +2018,11 @@ class Layers:
                 padding = 'SAME'
             # Average Pool Function
             self.input = tf.nn.avg_pool(self.input, ksize=[1, k1, k2, 1], strides=[1, s1, s2, 1], padding=padding)
-        print(scope + ' output: ' + str(self.input.get_shape()))
+            self._flops += self.num_elements(self.input.get_shape()[1:]) * int(k1) * int(k2)
+        self.log_layer(scope)
 
-    def res_layer(self, output_channels, filter_size=3, stride=1, activation_fn=tf.nn.relu, bottle=False,
-                  trainable=True):
+    def res_layer(self, output_channels, filter_size=3, stride=1, activation_fn=relu, bottle=False,
+                  trainable=True, recompute=False):
         """
         Residual Layer: Input -> BN, Act_fn, Conv1, BN, Act_fn, Conv 2 -> Output.  Return: Input + Output
         If stride > 1 or number of filters changes, decrease dims of Input by passing through a 1 x 1 Conv Layer
@@ -791,61 +2032,97 @@ class Layers:
         :param stride: int
         :param activation_fn: tf.nn function
         :param bottle: boolean
+        :param recompute: boolean, gradient checkpointing: only the block input is kept for the backward pass,
+            which recomputes the activations inside the block. Costs one more forward pass of the block.
+            The variables of the block are then resource variables, with the same names.
         """
         self.count['rn'] += 1
         scope = 'resnet_' + str(self.count['rn'])
-        input_channels = self.input.get_shape()[3]
-        with tf.variable_scope(scope):
 
-            # Determine Additive Output if dimensions change
-            # Decrease Input dimension with 1 x 1 Conv Layer with stride > 1
-            if (stride != 1) or (input_channels != output_channels):
-                with tf.variable_scope('conv0'):
-                    output_shape = [1, 1, input_channels, output_channels]
-                    w = self.weight_variable(name='weights', shape=output_shape, trainable=trainable)
-                    additive_output = tf.nn.conv2d(self.input, w, strides=[1, stride, stride, 1], padding='SAME')
-                    b = self.const_variable(name='bias', shape=[output_channels], value=0.0)
-                    additive_output = tf.add(additive_output, b)
-            else:
-                additive_output = self.input
+        def block(x):
+            return self.res_block(x, output_channels, filter_size, stride, activation_fn, bottle, trainable)
 
-            # First Conv Layer. Implement stride in this layer if desired.
-            with tf.variable_scope('conv1'):
-                fs = 1 if bottle else filter_size
-                oc = output_channels // 4 if bottle else output_channels
-                output_shape = [fs, fs, input_channels, oc]
+        recompute = recompute and Layers.frozen_values is None  # nothing to recompute without a backward pass
+        if recompute:
+            with tf.variable_scope(scope, use_resource=True):
+                self.input = tf.contrib.layers.recompute_grad(self.recomputable(block))(self.input)
+        else:
+            with tf.variable_scope(scope):
+                self.input = block(self.input)
+        self.log_layer(scope, recomputed=recompute)
+
+    def res_block(self, x, output_channels, filter_size, stride, activation_fn, bottle, trainable):
+        """ The residual block of res_layer as a function of its input, in the current variable scope """
+        input_channels = x.get_shape()[3]
+
+        # Determine Additive Output if dimensions change
+        # Decrease Input dimension with 1 x 1 Conv Layer with stride > 1
+        if (stride != 1) or (input_channels != output_channels):
+            with tf.variable_scope('conv0'):
+                output_shape = [1, 1, input_channels, output_channels]
                 w = self.weight_variable(name='weights', shape=output_shape, trainable=trainable)
-                self.input = self.batch_norm(self.input)
-                self.input = activation_fn(self.input)
-                self.input = tf.nn.conv2d(self.input, w, strides=[1, stride, stride, 1], padding='SAME')
-                b = self.const_variable(name='bias', shape=[oc], value=0.0)
-                self.input = tf.add(self.input, b)
-            # Second Conv Layer
-            with tf.variable_scope('conv2'):
-                input_channels = self.input.get_shape()[3]
-                oc = output_channels // 4 if bottle else output_channels
-                output_shape = [filter_size, filter_size, input_channels, oc]
+                additive_output = self.quantizable_conv2d(x, w, strides=[1, stride, stride, 1], padding='SAME')
+                b = self.const_variable(name='bias', shape=[output_channels], value=0.0, trainable=trainable)
+                additive_output = tf.add(additive_output, b)
+        else:
+            additive_output = x
+
+        # First Conv Layer. Implement stride in this layer if desired.
+        with tf.variable_scope('conv1'):
+            fs = 1 if bottle else filter_size
+            oc = output_channels // 4 if bottle else output_channels
+            output_shape = [fs, fs, input_channels, oc]
+            w = self.weight_variable(name='weights', shape=output_shape, trainable=trainable)
+            x = self.batch_norm(x)
+            x = activation_fn(x)
+            x = self.quantizable_conv2d(x, w, strides=[1, stride, stride, 1], padding='SAME')
+            b = self.const_variable(name='bias', shape=[oc], value=0.0, trainable=trainable)
+            x = tf.add(x, b)
+        # Second Conv Layer
+        with tf.variable_scope('conv2'):
+            input_channels = x.get_shape()[3]
+            oc = output_channels // 4 if bottle else output_channels
+            output_shape = [filter_size, filter_size, input_channels, oc]
+            w = self.weight_variable(name='weights', shape=output_shape, trainable=trainable)
+            x = self.batch_norm(x)
+            x = activation_fn(x)
+            x = self.quantizable_conv2d(x, w, strides=[1, 1, 1, 1], padding='SAME')
+            b = self.const_variable(name='bias', shape=[oc], value=0.0, trainable=trainable)
+            x = tf.add(x, b)
+        if bottle:
+            # Third Conv Layer
+            with tf.variable_scope('conv3'):
+                input_channels = x.get_shape()[3]
+                output_shape = [1, 1, input_channels, output_channels]
                 w = self.weight_variable(name='weights', shape=output_shape, trainable=trainable)
-                self.input = self.batch_norm(self.input)
-                self.input = activation_fn(self.input)
-                self.input = tf.nn.conv2d(self.input, w, strides=[1, 1, 1, 1], padding='SAME')
-                b = self.const_variable(name='bias', shape=[oc], value=0.0)
-                self.input = tf.add(self.input, b)
-            if bottle:
-                # Third Conv Layer
-                with tf.variable_scope('conv3'):
-                    input_channels = self.input.get_shape()[3]
-                    output_shape = [1, 1, input_channels, output_channels]
-                    w = self.weight_variable(name='weights', shape=output_shape, trainable=trainable)
-                    self.input = self.batch_norm(self.input)
-                    self.input = activation_fn(self.input)
-                    self.input = tf.nn.conv2d(self.input, w, strides=[1, 1, 1, 1], padding='SAME')
-                    b = self.const_variable(name='bias', shape=[output_channels], value=0.0)
-                    self.input = tf.add(self.input, b)
+                x = self.batch_norm(x)
+                x = activation_fn(x)
+                x = self.quantizable_conv2d(x, w, strides=[1, 1, 1, 1], padding='SAME')
+                b = self.const_variable(name='bias', shape=[output_channels], value=0.0, trainable=trainable)
+                x = tf.add(x, b)
 
-            # Add input and output for final return
-            self.input = self.input + additive_output
-        print(scope + ' output: ' + str(self.input.get_shape()))
+        # Add input and output for final return
+        return x + additive_output
+
+    @staticmethod
+    def recomputable(fn):
+        """
+        Wraps a block for tf.contrib.layers.recompute_grad, which calls it once in the forward pass and again in
+        the backward pass. During the second call Layers._recomputing is set, so weight losses and moving
+        average updates are not added twice.
+        """
+        calls = [0]
+
+        def wrapped(*args):
+            calls[0] += 1
+            if calls[0] == 1:
+                return fn(*args)
+            Layers._recomputing = True
+            try:
+                return fn(*args)
+            finally:
+                Layers._recomputing = False
+        return wrapped
 
     def noisy_and(self, num_classes, trainable=True):
         """ Multiple Instance Learning (MIL), flexible pooling function
@@ -859,7 +2136,88 @@ class Layers:
             mean = tf.reduce_mean(self.input, axis=[1, 2])
             self.input = (tf.nn.sigmoid(a * (mean - b)) - tf.nn.sigmoid(-a * b)) / (
                 tf.sigmoid(a * (1 - b)) - tf.sigmoid(-a * b))
-        print(scope + ' output: ' + str(self.input.get_shape()))
+        self.log_layer(scope)
+
+    def log_layer(self, scope, recomputed=False):
+        """ Prints the output shape of a layer and records its parameters, FLOPs and activation memory, counting
+        everything created since the previous layer. Recomputed layers only keep their output.
+        Only prints unless stats is set, as the graph scan makes construction slower. """
+        self.print_log(scope + ' output: ' + str(self.input.get_shape()), level=2)
+        if not self.stats:
+            self._flops = 0
+            return
+        variables = tf.get_collection_ref(tf.GraphKeys.GLOBAL_VARIABLES)[self._num_variables:]
+        trainable = tf.get_collection_ref(tf.GraphKeys.TRAINABLE_VARIABLES)[self._num_trainable:]
+        ops = tf.get_default_graph().get_operations()[self._num_ops:]
+        self.layer_stats.append({
+            'name': scope, 'output_shape': self.input.get_shape().as_list(),
+            'params': sum(self.num_elements(v.get_shape()) for v in trainable),
+            'variable_bytes': sum(self.num_elements(v.get_shape()) * v.dtype.base_dtype.size for v in variables),
+            'flops': self._flops,
+            'activation_bytes': self.num_elements(self.input.get_shape()[1:]) * self.input.dtype.size if recomputed
+            else self.activation_bytes(ops)})
+        self._flops = 0
+        self._num_variables += len(variables)
+        self._num_trainable += len(trainable)
+        self._num_ops += len(ops)
+
+    # Ops whose outputs are constants, variables or views of other tensors, and so take no activation memory
+    _NO_ACTIVATION_OPS = {'Const', 'VariableV2', 'Variable', 'VarHandleOp', 'ReadVariableOp', 'Identity', 'Reshape',
+                          'Squeeze', 'ExpandDims', 'Shape', 'Placeholder', 'PlaceholderWithDefault', 'Assign'}
+
+    def activation_bytes(self, ops):
+        """ Bytes per example of the floating point batch tensors that ops output, i.e. the forward activations
+        a train step keeps for the backward pass """
+        total = 0
+        for op in ops:
+            if op.type in self._NO_ACTIVATION_OPS:
+                continue
+            for t in op.outputs:
+                shape = t.get_shape()
+                if not t.dtype.is_floating or not shape.ndims or shape[0].value != self._batch_dim:
+                    continue
+                total += self.num_elements(shape[1:]) * t.dtype.size
+        return total
+
+    def summary(self, memory_budget=None, fixed_bytes=0):
+        """
+        Prints a table of the layers built so far and their totals
+        :param memory_budget: int, bytes. If given, the largest batch size whose variables and activations fit
+        :param fixed_bytes: int, memory needed besides the variables of the layers, e.g. optimizer slots
+        :return: dict of totals, with 'max_batch_size' if memory_budget is given
+        """
+        if not self.stats:
+            raise ValueError('Layer statistics are only recorded by Layers(..., stats=True)')
+        lines = ['%-14s %-22s %12s %14s %14s' % ('layer', 'output shape', 'params', 'MFLOPs/example',
+                                                 'act KB/example')]
+        for stats in self.layer_stats:
+            lines.append('%-14s %-22s %12d %14.2f %14.1f' % (
+                stats['name'], stats['output_shape'], stats['params'], stats['flops'] / 1e6,
+                stats['activation_bytes'] / 2 ** 10))
+        totals = {key: sum(stats[key] for stats in self.layer_stats)
+                  for key in ['params', 'variable_bytes', 'flops', 'activation_bytes']}
+        lines.append('Total: %d params (%.2f MB of variables), %.2f MFLOPs and %.2f MB of activations per example' %
+                     (totals['params'], totals['variable_bytes'] / 2 ** 20, totals['flops'] / 1e6,
+                      totals['activation_bytes'] / 2 ** 20))
+        if memory_budget is not None:
+            totals['max_batch_size'] = self.max_batch_size(memory_budget, totals['variable_bytes'] + fixed_bytes,
+                                                           totals['activation_bytes'])
+            lines.append('Max batch size for %.2f MB: %d' % (memory_budget / 2 ** 20, totals['max_batch_size']))
+        self.print_log('\n'.join(lines))
+        return totals
+
+    @staticmethod
+    def max_batch_size(memory_budget, fixed_bytes, bytes_per_example):
+        """ Largest batch size with fixed_bytes + batch_size * bytes_per_example <= memory_budget """
+        if bytes_per_example <= 0:
+            return 0
+        return max(int((memory_budget - fixed_bytes) // bytes_per_example), 0)
+
+    @staticmethod
+    def num_elements(shape):
+        """ Number of elements of a static shape, or 0 if it is not fully defined """
+        num = tf.TensorShape(shape).num_elements()
+        return 0 if num is None else num
 
     def get_output(self):
         """
@@ -881,39 +2239,237 @@ class Layers:
         else:  # type == 'fc'
             size = [0]
 
-        # Calculate batch mean and variance
-        batch_mean1, batch_var1 = tf.nn.moments(x, size, keep_dims=True)
+        # Calculate batch mean and variance, or moving averages at inference
+        batch_mean1, batch_var1 = self.moments(x, size)
 
         # Apply the initial batch normalizing transform
         z1_hat = (x - batch_mean1) / tf.sqrt(batch_var1 + epsilon)
         return z1_hat
 
+    def moments(self, x, axes, decay=0.99):
+        """
+        Mean and variance for batch normalization, with the dims of axes kept.
+        If self.training is not None, 'moving_mean' and 'moving_variance' are created in the current variable
+        scope. Training returns the batch moments and updates the averages; inference returns the averages.
+        :param x: input feature map stack
+        :param axes: list of ints, every axis except the last (channels)
+        :param decay: float, decay of the moving averages
+        :return: mean, variance
+        """
+        batch_mean, batch_var = tf.nn.moments(x, axes, keep_dims=True)
+        training = self.is_training()
+        if training is None:
+            return batch_mean, batch_var
+        moving_mean, moving_var = self.moving_moments(x.get_shape()[-1])
+
+        def train_moments():
+            if Layers._recomputing:  # the forward pass already updated the averages with these moments
+                return batch_mean, batch_var
+            update_mean = tf.assign(moving_mean, moving_mean * decay + tf.reshape(batch_mean, [-1]) * (1 - decay))
+            update_var = tf.assign(moving_var, moving_var * decay + tf.reshape(batch_var, [-1]) * (1 - decay))
+            with tf.control_dependencies([update_mean, update_var]):
+                return tf.identity(batch_mean), tf.identity(batch_var)
+
+        def inference_moments():
+            shape = [1] * len(axes) + [-1]
+            return tf.reshape(moving_mean, shape), tf.reshape(moving_var, shape)
+
+        if isinstance(training, bool):
+            return train_moments() if training else inference_moments()
+        return tf.cond(training, train_moments, inference_moments)
+
+    def is_training(self):
+        """ The training switch of batch normalization. Frozen inference graphs always use the moving averages. """
+        if Layers.frozen_values is not None and self.training is not None:
+            return False
+        return self.training
+
     @staticmethod
-    def print_log(message):
-        """ Writes a message to terminal screen and logging file, if applicable"""
-        print(message)
+    def moving_moments(channels):
+        """ Gets or creates the moving mean and variance variables of the current variable scope """
+        if Layers.frozen_values is not None:
+            return Layers.frozen_constant('moving_mean'), Layers.frozen_constant('moving_variance')
+        moving_mean = tf.get_variable('moving_mean', [channels], initializer=tf.zeros_initializer(), trainable=False)
+        moving_var = tf.get_variable('moving_variance', [channels], initializer=tf.ones_initializer(),
+                                     trainable=False)
+        return moving_mean, moving_var
+
+    def fused_batch_norm(self, x, channels, b_value, s_value, trainable, type='conv', epsilon=1e-3, decay=0.99):
+        """
+        Batch normalization followed by bias and scale, as one fused_batch_norm op:
+        ((x - mean) / std + bias) * scale = (x - mean) / std * scale + bias * scale
+        :param x: input feature map stack
+        :param channels: int, number of output channels
+        :param b_value: float or None, initial bias as in conv2d
+        :param s_value: float or None, initial scale as in conv2d
+        :param trainable: bool
+        :param type: string, either 'conv' or 'fc'
+        :param epsilon: float
+        :param decay: float, decay of the moving averages if self.training is not None
+        :return: output feature map stack
+        """
+        channels = int(channels)
+        if b_value is not None:
+            b = self.const_variable(name='bias', shape=[channels], value=b_value, trainable=trainable)
+        else:
+            b = tf.zeros([channels])
+        if s_value is not None:
+            s = self.const_variable(name='scale', shape=[channels], value=s_value, trainable=trainable)
+        else:
+            s = tf.ones([channels])
+        offset = b * s
+        if type == 'fc':  # fused kernel expects NHWC
+            x = tf.reshape(x, [-1, 1, 1, channels])
+
+        training = self.is_training()
+        if training is None:
+            y, _, _ = tf.nn.fused_batch_norm(x, s, offset, epsilon=epsilon, is_training=True)
+        else:
+            moving_mean, moving_var = self.moving_moments(channels)
+
+            def train_norm():
+                y, batch_mean, batch_var = tf.nn.fused_batch_norm(x, s, offset, epsilon=epsilon, is_training=True)
+                # The fused kernel returns the unbiased variance; average the biased one, as moments does, so that
+                # moving_variance means the same on both paths
+                n = tf.cast(tf.size(x) // channels, batch_var.dtype)
+                batch_var = batch_var * (n - 1) / tf.maximum(n, 1)
+                update_mean = tf.assign(moving_mean, moving_mean * decay + batch_mean * (1 - decay))
+                update_var = tf.assign(moving_var, moving_var * decay + batch_var * (1 - decay))
+                with tf.control_dependencies([update_mean, update_var]):
+                    return tf.identity(y)
+
+            def inference_norm():
+                y, _, _ = tf.nn.fused_batch_norm(x, s, offset, mean=moving_mean, variance=moving_var,
+                                                 epsilon=epsilon, is_training=False)
+                return y
+
+            if isinstance(training, bool):
+                y = train_norm() if training else inference_norm()
+            else:
+                y = tf.cond(training, train_norm, inference_norm)
+
+        if type == 'fc':
+            y = tf.reshape(y, [-1, channels])
+        return y
+
+    @staticmethod
+    def print_log(message, level=1):
+        """ Writes a message to terminal screen, if level is within the verbosity, and logging file, if applicable"""
+        if level <= _verbosity:
+            print(message)
         logging.info(message)
 
     @staticmethod
-    def weight_variable(name, shape, trainable):
+    def weight_variable(name, shape, trainable=True):
         """
         :param name: string
         :param shape: 4D array
         :return: tf variable
         """
+        if Layers.frozen_values is not None:
+            return Layers.frozen_constant(name)
         w = tf.get_variable(name=name, shape=shape, initializer=tf.contrib.layers.variance_scaling_initializer(),
                             trainable=trainable)
-        weights_norm = tf.reduce_sum(tf.nn.l2_loss(w),
-                                     name=name + '_norm')  # Should user want to optimize weight decay
-        tf.add_to_collection('weight_losses', weights_norm)
+        if not Layers._recomputing:
+            weights_norm = tf.reduce_sum(tf.nn.l2_loss(w),
+                                         name=name + '_norm')  # Should user want to optimize weight decay
+            tf.add_to_collection('weight_losses', weights_norm)
         return w
 
     @staticmethod
-    def const_variable(name, shape, value, trainable):
+    def const_variable(name, shape, value, trainable=True):
         """
         :param name: string
         :param shape: 1D array
         :param value: float
         :return: tf variable
         """
+        if Layers.frozen_values is not None:
+            return Layers.frozen_constant(name)
         return tf.get_variable(name, shape, initializer=tf.constant_initializer(value), trainable=trainable)
+
+    @staticmethod
+    def frozen_constant(name):
+        """ Returns the trained value of variable name in the current variable scope as a constant """
+        scope = tf.get_variable_scope().name
+        full_name = scope + '/' + name if scope else name
+        return tf.constant(Layers.frozen_values[full_name], name=name)
+
+    def quantizable_conv2d(self, x, w, strides, padding):
+        """ tf.nn.conv2d, or QuantizedConv2D on eight-bit input and weights when building a quantized graph """
+        scope = tf.get_variable_scope().name
+        if Layers.calibration_inputs is not None:
+            Layers.calibration_inputs[scope] = x
+        if Layers.quantize_ranges is None:
+            y = tf.nn.conv2d(x, w, strides=strides, padding=padding)
+        else:
+            qx, qw, w_min, w_max = self.quantize_operands(x, w, scope)
+            y, y_min, y_max = tf.nn.quantized_conv2d(qx.output, qw, qx.output_min, qx.output_max, w_min, w_max,
+                                                     strides=strides, padding=padding)
+            y = tf.dequantize(y, y_min, y_max)
+        if not Layers._recomputing:
+            self._flops += 2 * self.num_elements(y.get_shape()[1:3]) * self.num_elements(w.get_shape())
+        return y
+
+    def quantizable_matmul(self, x, w):
+        """ tf.matmul, or QuantizedMatMul on eight-bit input and weights when building a quantized graph """
+        scope = tf.get_variable_scope().name
+        if Layers.calibration_inputs is not None:
+            Layers.calibration_inputs[scope] = x
+        self._flops += 2 * self.num_elements(w.get_shape())
+        if Layers.quantize_ranges is None:
+            return tf.matmul(x, w)
+        from tensorflow.python.ops import gen_math_ops
+        qx, qw, w_min, w_max = self.quantize_operands(x, w, scope)
+        y, y_min, y_max = gen_math_ops.quantized_mat_mul(qx.output, qw, qx.output_min, qx.output_max, w_min, w_max,
+                                                          Toutput=tf.qint32)
+        return tf.dequantize(y, y_min, y_max)
+
+    @staticmethod
+    def quantize_operands(x, w, scope):
+        """
+        Quantizes a layer input to quint8 with its calibrated range, and its constant weights to a quint8 constant
+        (MIN_COMBINED: value = min + q * (max - min) / 255, with the range widened to include 0)
+        :return: quantize_v2 result of x, quantized weights, weight min, weight max
+        """
+        x_min, x_max = Layers.quantize_ranges[scope]
+        qx = tf.quantize_v2(x, x_min, max(x_max, x_min + 1e-6), tf.quint8)
+        value = tf.contrib.util.constant_value(w)
+        w_min = min(float(value.min()), 0.0)
+        w_max = max(float(value.max()), 0.0, w_min + 1e-6)
+        q = np.round((value - w_min) * (255 / (w_max - w_min))).astype(np.uint8)
+        return qx, tf.constant(q, dtype=tf.quint8, name='quantized_weights'), w_min, w_max
+
+    def folded_parameters(self, w_axis, bn, b_value, s_value, epsilon=1e-3):
+        """
+        When building a frozen inference graph, folds batch normalization (with moving averages), bias and
+        scale of the current layer into its weights: ((x * w - mean) / std + bias) * scale
+        = x * (w * scale / std) + (bias - mean / std) * scale
+        :param w_axis: int, output channel axis of the weights
+        :param bn: bool
+        :param b_value: float or None, as passed to the layer
+        :param s_value: float or None, as passed to the layer
+        :param epsilon: float, as in batch_norm
+        :return: (folded weights, folded bias) constants, or None if not frozen or bn uses batch moments
+        """
+        if Layers.frozen_values is None:
+            return None
+        scope = tf.get_variable_scope().name
+        prefix = scope + '/' if scope else ''
+        values = Layers.frozen_values
+        w = values[prefix + 'weights']
+        channels = w.shape[w_axis]
+        mean = np.zeros(channels)
+        inv_std = np.ones(channels)
+        if bn is True:
+            if prefix + 'moving_mean' not in values:  # normalized with batch moments, which cannot be folded
+                return None
+            mean = values[prefix + 'moving_mean']
+            inv_std = 1 / np.sqrt(values[prefix + 'moving_variance'] + epsilon)
+        bias = values[prefix + 'bias'] if b_value is not None else np.zeros(channels)
+        scale = values[prefix + 'scale'] if s_value is not None else np.ones(channels)
+        shape = [1] * w.ndim
+        shape[w_axis] = -1
+        folded_w = (w * (inv_std * scale).reshape(shape)).astype(w.dtype)
+        folded_b = ((bias - mean * inv_std) * scale).astype(w.dtype)
+        return tf.constant(folded_w, name='folded_weights'), tf.constant(folded_b, name='folded_bias')
@@ -10,17 +10,24 @@ Adapted from https://github.com/tensorflow/tensorflow/blob/master/tensorflow/con
 from .base import Data
 from shutil import copyfile
 import numpy as np
+import json
 import os
 import gzip
-import urllib.request
 
 
 class Mnist(Data):
-    def __init__(self, flags):
-        super().__init__(flags)
+    def __init__(self, flags, cache=True, **kwargs):
+        """
+        :param flags: dict, must contain 'data_directory'
+        :param cache: bool, keep decoded arrays as .npy files next to the downloaded files and reuse them
+        Labels are stored as uint8 class indices and one-hot encoded per batch (num_classes=10), pass
+        num_classes=None to get the class indices instead.
+        """
+        self.cache = cache
+        kwargs.setdefault('num_classes', 10)
+        super().__init__(flags, **kwargs)
 
     def load_data(self, test_percent=0.15):
-        one_hot = True
         validation_size = 5000
 
         SOURCE_URL = 'http://yann.lecun.com/exdb/mnist/'
@@ -29,27 +36,71 @@ class Mnist(Data):
         TEST_IMAGES = 't10k-images-idx3-ubyte.gz'
         TEST_LABELS = 't10k-labels-idx1-ubyte.gz'
 
-        local_file = self.maybe_download(TRAIN_IMAGES, self.flags['data_directory'], SOURCE_URL + TRAIN_IMAGES)
-        with open(local_file, 'rb') as f:
-            train_images = self.extract_images(f)
-
-        local_file = self.maybe_download(TRAIN_LABELS, self.flags['data_directory'], SOURCE_URL + TRAIN_LABELS)
-        with open(local_file, 'rb') as f:
-            train_labels = self.extract_labels(f, one_hot=one_hot)
-
-        local_file = self.maybe_download(TEST_IMAGES, self.flags['data_directory'], SOURCE_URL + TEST_IMAGES)
-        with open(local_file, 'rb') as f:
-            test_images = self.extract_images(f)
-
-        local_file = self.maybe_download(TEST_LABELS, self.flags['data_directory'], SOURCE_URL + TEST_LABELS)
-        with open(local_file, 'rb') as f:
-            test_labels = self.extract_labels(f, one_hot=one_hot)
+        train_images = self.load_array(TRAIN_IMAGES, SOURCE_URL, self.extract_images)
+        train_labels = self.load_array(TRAIN_LABELS, SOURCE_URL, self.extract_labels)
+        test_images = self.load_array(TEST_IMAGES, SOURCE_URL, self.extract_images)
+        test_labels = self.load_array(TEST_LABELS, SOURCE_URL, self.extract_labels)
 
         if not 0 <= validation_size <= len(train_labels):
             raise ValueError(
                 'Validation size should be between 0 and {}. Received: {}.'.format(len(train_labels), validation_size))
         return train_images, train_labels, test_images, test_labels
 
+    def load_array(self, filename, source_url, extract_fn):
+        """Parse a downloaded IDX file, or memory-map its decoded cache if the cache is still valid.
+        The cache is a .npy file next to the .gz file, with a .json stamp of the source size and mtime.
+        Args:
+            filename: string, name of the .gz file in the data directory.
+            source_url: url directory to download from if the file doesn't exist.
+            extract_fn: function that parses the opened .gz file into a numpy array.
+        Returns:
+            numpy array.
+        """
+        local_file = self.maybe_download(filename, self.flags['data_directory'], source_url + filename)
+        if not self.cache:
+            with open(local_file, 'rb') as f:
+                return extract_fn(f)
+        cache_file = os.path.splitext(local_file)[0] + '.npy'
+        stamp = self._source_stamp(local_file)
+        if self._read_stamp(cache_file) == stamp:
+            return np.load(cache_file, mmap_mode='r')
+        with open(local_file, 'rb') as f:
+            data = extract_fn(f)
+        self._write_cache(cache_file, data, stamp)
+        return data
+
+    @staticmethod
+    def _source_stamp(filepath):
+        stat = os.stat(filepath)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    @staticmethod
+    def _read_stamp(cache_file):
+        """Return the stamp of a cache file, or None if there is no complete cache."""
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            with open(cache_file + '.json', 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_cache(cache_file, data, stamp):
+        """Write the array and then its stamp, each through a temporary file, so concurrent jobs never
+        read a partial cache. Failures (e.g. a read-only data directory) only disable caching."""
+        try:
+            tmp_file = cache_file + '.%d.tmp' % os.getpid()
+            with open(tmp_file, 'wb') as f:
+                np.save(f, data)
+            os.replace(tmp_file, cache_file)
+            with open(tmp_file, 'w') as f:
+                json.dump(stamp, f)
+            os.replace(tmp_file, cache_file + '.json')
+            print('Cached', cache_file)
+        except OSError as e:
+            print('Could not cache %s: %s' % (cache_file, e))
+
     def maybe_download(self, filename, work_directory, source_url):
         """Download the data from source url, unless it's already here.
         Args:
@@ -63,6 +114,7 @@ class Mnist(Data):
             os.makedirs(work_directory)
         filepath = os.path.join(work_directory, filename)
         if not os.path.exists(filepath):
+            import urllib.request
             temp_file_name, _ = urllib.request.urlretrieve(source_url)
             copyfile(temp_file_name, filepath)
             print('Successfully downloaded', filename)
@@ -81,7 +81,7 @@ class BayesLadder(Layers):
                 self.input = tf.mul(self.input, s)
             if activation_fn is not None:  # activation function
                 self.input = activation_fn(self.input)
-        self.print_log(scope + ' output: ' + str(self.input.get_shape()))
+        self.log_layer(scope)
 
     def deconv2d(self, filter_size, output_channels, stride=1, padding='SAME', stoch=False, ladder=None,
                  activation_fn=tf.nn.relu, b_value=0.0, s_value=1.0, bn=True):
@@ -153,14 +153,14 @@ class BayesLadder(Layers):
                 self.input = tf.mul(self.input, s)
             if activation_fn is not None:  # non-linear activation function
                 self.input = activation_fn(self.input)
-        self.print_log(scope + ' output: ' + str(self.input.get_shape()))  # print shape of output
+        self.log_layer(scope)  # print shape of output
 
 
 
 
 class Ladder(Layers):
-    def __init__(self, x, layer_num=0, z_noisy_dict=dict(), clean_batch=dict()):
-        super().__init__(x)
+    def __init__(self, x, layer_num=0, z_noisy_dict=dict(), clean_batch=dict(), training=None):
+        super().__init__(x, training)
         self._noisy_z_dict = z_noisy_dict  # for ladder network
         self.clean_batch_dict = clean_batch  # for ladder network
         self._clean_z = dict()  # for ladder network
@@ -203,7 +203,7 @@ class Ladder(Layers):
                 self.input = tf.multiply(self.input, s)
             if activation_fn is not None:
                 self.input = activation_fn(self.input)
-        self.print_log(scope + ' output: ' + str(self.input.get_shape()))
+        self.log_layer(scope)
 
     def deconv2d(self, filter_size, output_channels, stride=1, padding='SAME', activation_fn=tf.nn.relu, b_value=0.0, s_value=1.0, bn=True, ladder=False):
         self.count['deconv'] += 1
@@ -249,7 +249,7 @@ class Ladder(Layers):
                 self.input = tf.multiply(self.input, s)
             if activation_fn is not None:
                 self.input = activation_fn(self.input)
-        self.print_log(scope + ' output: ' + str(self.input.get_shape()))
+        self.log_layer(scope)
 
     def fc(self, output_nodes, keep_prob=1, activation_fn=tf.nn.relu, b_value=0.0, s_value=None, bn=False, stoch=False, ladder=False, clean=False):
         self.count['fc'] += 1
@@ -281,7 +281,7 @@ class Ladder(Layers):
                 self.input = activation_fn(self.input)
             if keep_prob != 1:
                 self.input = tf.nn.dropout(self.input, keep_prob=keep_prob)
-        self.print_log(scope + ' output: ' + str(self.input.get_shape()))
+        self.log_layer(scope)
 
     def ladder_g_function(self, noisy_z, u):
         shape = [noisy_z.get_shape()[3]]
@@ -302,8 +302,8 @@ class Ladder(Layers):
         return (noisy_z - mu) * nu + mu
 
     def batch_norm(self, x, epsilon=1e-3, clean=False, count=1):
-        # Calculate batch mean and variance
-        batch_mean1, batch_var1 = tf.nn.moments(x, [0], keep_dims=True)
+        # Calculate batch mean and variance, or moving averages at inference
+        batch_mean1, batch_var1 = self.moments(x, [0])
 
         # Apply the initial batch normalizing transform
         z1_hat = (x - batch_mean1) / tf.sqrt(batch_var1 + epsilon)
@@ -313,8 +313,8 @@ class Ladder(Layers):
         return z1_hat
 
     def conv_batch_norm(self, x, epsilon=1e-3, clean=False, count=1):
-        # Calculate batch mean and variance
-        batch_mean1, batch_var1 = tf.nn.moments(x, [0, 1, 2], keep_dims=True)
+        # Calculate batch mean and variance, or moving averages at inference
+        batch_mean1, batch_var1 = self.moments(x, [0, 1, 2])
 
         # Apply the initial batch normalizing transform
         z1_hat = (x - batch_mean1) / tf.sqrt(batch_var1 + epsilon)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+Purpose: Export in-memory Data subclasses to sharded TFRecord files for Data.batch_inputs and Data.dataset_inputs
+Classes:
+    RecordExporter
+"""
+
+import tensorflow as tf
+import numpy as np
+import multiprocessing
+import json
+import os
+import shutil
+import tempfile
+
+
+def _array_source(array, temp_directory, name):
+    """
+    Returns (filename, dtype, shape, offset) from which a spawned worker memory-maps array. C-contiguous memmaps
+    (e.g. the splits of MemmapData) are opened from their own file, other arrays are first written to temp_directory.
+    """
+    if isinstance(array, np.memmap) and array.filename is not None and array.flags.c_contiguous:
+        root = array
+        while isinstance(root.base, np.ndarray):
+            root = root.base
+        return array.filename, array.dtype.str, array.shape, array.offset + array.ctypes.data - root.ctypes.data
+    filename = os.path.join(temp_directory, name + '.bin')
+    np.ascontiguousarray(array).tofile(filename)
+    return filename, array.dtype.str, array.shape, 0
+
+
+def _write_shard(args):
+    """ Writes images[start:end] and labels[start:end] to one TFRecord file. Runs in a spawned pool worker, which
+    imports TensorFlow itself and memory-maps the arrays described by _array_source. """
+    image_source, label_source, filename, start, end, compression = args
+    if end > start:
+        images, labels = [np.memmap(source, dtype=dtype, mode='r', offset=offset, shape=tuple(shape))
+                          for source, dtype, shape, offset in [image_source, label_source]]
+    options = None
+    if compression is not None:
+        options = tf.python_io.TFRecordOptions(getattr(tf.python_io.TFRecordCompressionType, compression))
+    with tf.python_io.TFRecordWriter(filename, options=options) as writer:
+        for i in range(start, end):
+            example = tf.train.Example(features=tf.train.Features(feature={
+                'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[np.asarray(images[i]).tobytes()])),
+                'label': tf.train.Feature(bytes_list=tf.train.BytesList(value=[np.asarray(labels[i]).tobytes()]))}))
+            writer.write(example.SerializeToString())
+    return end - start
+
+
+class RecordExporter:
+    """
+    Converts the train/valid/test splits of a Data instance (e.g. Mnist) into balanced TFRecord shards,
+    written in parallel by a process pool, and a manifest.json with shapes, dtypes and record counts.
+    read_and_decode_fn rebuilds the matching parser from the manifest.
+    The pool workers are spawned, not forked, as forking a process that runs TensorFlow is unsafe. Scripts that
+    call export must therefore guard their entry point with if __name__ == '__main__'.
+    """
+
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, data, output_directory, num_shards=10, compression=None, num_processes=None):
+        """
+        :param data: Data instance, whose stored (not normalized) arrays are exported
+        :param output_directory: string
+        :param num_shards: int, number of files per split
+        :param compression: None, 'GZIP' or 'ZLIB'
+        :param num_processes: int, size of the process pool. Defaults to the number of CPUs
+        """
+        self.data = data
+        self.output_directory = output_directory
+        self.num_shards = num_shards
+        self.compression = compression
+        self.num_processes = num_processes
+
+    def export(self, splits=('train', 'valid', 'test')):
+        """
+        Writes the shards and the manifest
+        :param splits: list of strings, names of the Data splits to export
+        :return: dict, manifest
+        """
+        if not os.path.exists(self.output_directory):
+            os.makedirs(self.output_directory)
+        images = getattr(self.data, splits[0] + '_images')
+        labels = getattr(self.data, splits[0] + '_labels')
+        manifest = {'compression': self.compression,
+                    'image_shape': list(images.shape[1:]), 'image_dtype': images.dtype.name,
+                    'label_shape': list(labels.shape[1:]), 'label_dtype': labels.dtype.name,
+                    'num_classes': getattr(self.data, 'num_classes', None),
+                    'splits': dict()}
+        temp_directory = tempfile.mkdtemp()
+        try:
+            with multiprocessing.get_context('spawn').Pool(self.num_processes) as pool:
+                for split in splits:
+                    images = getattr(self.data, split + '_images')
+                    labels = getattr(self.data, split + '_labels')
+                    num_records = len(labels)
+                    num_shards = max(1, min(self.num_shards, num_records))
+                    bounds = np.linspace(0, num_records, num_shards + 1).astype(int)
+                    filenames = [os.path.join(self.output_directory,
+                                              '%s-%05d-of-%05d.tfrecord' % (split, i, num_shards))
+                                 for i in range(num_shards)]
+                    sources = [_array_source(images, temp_directory, split + '_images'),
+                               _array_source(labels, temp_directory, split + '_labels')] if num_records else [None] * 2
+                    jobs = [(sources[0], sources[1], filenames[i], int(bounds[i]), int(bounds[i + 1]),
+                             self.compression) for i in range(num_shards)]
+                    counts = pool.map(_write_shard, jobs)
+                    manifest['splits'][split] = {'files': [os.path.basename(f) for f in filenames],
+                                                 'counts': counts, 'num_records': int(sum(counts))}
+                    print('Wrote %d %s records to %d shards' % (sum(counts), split, num_shards))
+        finally:
+            shutil.rmtree(temp_directory)
+        with open(os.path.join(self.output_directory, self.MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+    @classmethod
+    def load_manifest(cls, output_directory):
+        """ Returns the manifest written by export """
+        with open(os.path.join(output_directory, cls.MANIFEST), 'r') as f:
+            return json.load(f)
+
+    @classmethod
+    def split_files(cls, output_directory, split):
+        """ Returns the full paths of a split's shards, for the tf_file(s) argument of the Data input pipelines """
+        manifest = cls.load_manifest(output_directory)
+        return [os.path.join(output_directory, f) for f in manifest['splits'][split]['files']]
+
+    @staticmethod
+    def read_and_decode_fn(manifest, normalize=True, max_val=255):
+        """
+        Builds the parser for the records described by a manifest
+        :param manifest: dict, as returned by export or load_manifest
+        :param normalize: bool, scale images to [-1, 1] and one-hot encode labels if num_classes is known,
+            as Data does on the host
+        :param max_val: int, maximum value of the stored images
+        :return: function from a serialized example to [image, label]
+        """
+        def read_and_decode(example_serialized):
+            features = tf.parse_single_example(example_serialized, features={
+                'image': tf.FixedLenFeature([], tf.string), 'label': tf.FixedLenFeature([], tf.string)})
+            image = tf.decode_raw(features['image'], tf.as_dtype(manifest['image_dtype']))
+            image = tf.reshape(image, manifest['image_shape'])
+            label = tf.decode_raw(features['label'], tf.as_dtype(manifest['label_dtype']))
+            label = tf.reshape(label, manifest['label_shape'])
+            if normalize:
+                image = (tf.cast(image, tf.float32) * (2 / max_val)) - 1
+                if manifest['num_classes'] is not None:
+                    label = tf.one_hot(tf.cast(label, tf.int32), manifest['num_classes'])
+            return [image, label]
+        return read_and_decode
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+"""
+Purpose: Serve predictions of a restored Model with dynamic batching
+Classes:
+    InferenceServer
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import numpy as np
+import collections
+import json
+import queue
+import threading
+import time
+
+
+class _Request:
+    """ One example waiting for its prediction """
+
+    def __init__(self, example):
+        self.example = example
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class InferenceServer:
+    """
+    Runs the session of a restored Model on dynamically formed batches. Concurrent predict calls are queued, and a
+    single worker thread copies up to max_batch_size of them into a preallocated input buffer, waiting at most
+    max_latency_ms after the first one, then runs one sess.run for the whole batch.
+    serve_http adds a loopback JSON front end: POST /predict {"instances": [...]} and GET /stats.
+    """
+
+    def __init__(self, model, inputs, outputs, max_batch_size=32, max_latency_ms=5.0, feed_dict=None, pad=False,
+                 input_shape=None, history=10000):
+        """
+        :param model: Model, restored, whose session is used
+        :param inputs: placeholder of the input batch
+        :param outputs: tensor or list of tensors with the batch as first dimension
+        :param max_batch_size: int
+        :param max_latency_ms: float, longest time the first request of a batch waits for more requests
+        :param feed_dict: dict, extra constant feeds (e.g. dropout keep probability 1, training False)
+        :param pad: bool, always feed the whole buffer, for graphs with a fixed batch dimension
+        :param input_shape: list, shape of one example, if it is not fully defined by inputs
+        :param history: int, number of most recent request latencies kept for the percentiles
+        """
+        self.sess = model.sess
+        self.inputs = inputs
+        self.outputs = outputs
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.feed_dict = dict() if feed_dict is None else dict(feed_dict)
+        self.pad = pad
+        if input_shape is None:
+            input_shape = inputs.get_shape().as_list()[1:]
+        self._buffer = np.zeros([max_batch_size] + list(input_shape), dtype=inputs.dtype.as_numpy_dtype)
+        self._queue = queue.Queue()
+        self._latencies = collections.deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._num_requests = 0
+        self._num_batches = 0
+        self._run_time = 0.0
+        self._http = None
+        self._closed = False
+        self._worker_thread = threading.Thread(target=self._worker, daemon=True)
+        self._worker_thread.start()
+
+    def predict(self, example, timeout=None):
+        """
+        Blocks until the prediction of one example is ready
+        :param example: numpy array of one example, without the batch dimension
+        :param timeout: float, seconds
+        :return: numpy array, or list of numpy arrays if outputs is a list or tuple
+        """
+        return self._wait(self._submit(example), timeout)
+
+    def predict_many(self, examples, timeout=None):
+        """ Submits several examples at once, so they can share batches, and returns their predictions in order.
+        All shapes are checked before any example is submitted. """
+        examples = [self._check_example(example) for example in examples]
+        requests = [self._submit(example) for example in examples]
+        return [self._wait(request, timeout) for request in requests]
+
+    def stats(self):
+        """ Returns a dict of request counters, throughput and p50/p99 latency over the recent requests """
+        with self._lock:
+            latencies = np.array(self._latencies)
+            num_requests, num_batches, run_time = self._num_requests, self._num_batches, self._run_time
+        elapsed = time.time() - self._start_time
+        stats = {'requests': num_requests, 'batches': num_batches,
+                 'mean_batch_size': num_requests / num_batches if num_batches else 0.0,
+                 'requests_per_sec': num_requests / elapsed if elapsed > 0 else 0.0,
+                 'run_ms_per_batch': 1000 * run_time / num_batches if num_batches else 0.0,
+                 'queue_depth': self._queue.qsize()}
+        if len(latencies):
+            stats['p50_ms'] = 1000 * float(np.percentile(latencies, 50))
+            stats['p99_ms'] = 1000 * float(np.percentile(latencies, 99))
+        return stats
+
+    def serve_http(self, port=8000, host='127.0.0.1'):
+        """
+        Starts the JSON front end on a background thread
+        :return: the HTTPServer, whose server_address holds the bound port (port=0 picks a free one)
+        """
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/stats':
+                    return self.send_error(404)
+                self._reply(server.stats())
+
+            def do_POST(self):
+                if self.path != '/predict':
+                    return self.send_error(404)
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                    examples = [np.asarray(instance, dtype=server._buffer.dtype) for instance in body['instances']]
+                except (KeyError, TypeError, ValueError) as e:
+                    return self.send_error(400, str(e))
+                try:
+                    predictions = server.predict_many(examples)
+                except ValueError as e:  # wrong example shape
+                    return self.send_error(400, str(e))
+                except Exception as e:  # sess.run failed, timed out or the server is closed
+                    return self.send_error(500, str(e))
+                self._reply({'predictions': [[p.tolist() for p in prediction] if isinstance(prediction, (list, tuple))
+                                             else prediction.tolist() for prediction in predictions]})
+
+            def _reply(self, obj):
+                data = json.dumps(obj).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):  # keep request logs out of the training log
+                pass
+
+        self._http = _ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._http.serve_forever, daemon=True).start()
+        print('Serving predictions on http://%s:%d' % self._http.server_address[:2])
+        return self._http
+
+    def close(self):
+        """ Stops the HTTP front end and the worker. Requests still queued fail. """
+        if self._http is not None:
+            self._http.shutdown()
+            self._http.server_close()
+            self._http = None
+        self._closed = True
+        self._queue.put(None)
+        self._worker_thread.join()
+
+    def _check_example(self, example):
+        example = np.asarray(example)
+        if example.shape != self._buffer.shape[1:]:
+            raise ValueError('Expected an example of shape %s, got %s' % (self._buffer.shape[1:], example.shape))
+        return example
+
+    def _submit(self, example):
+        if self._closed:
+            raise RuntimeError('InferenceServer is closed')
+        request = _Request(self._check_example(example))
+        self._queue.put(request)
+        return request
+
+    @staticmethod
+    def _wait(request, timeout):
+        if not request.done.wait(timeout):
+            raise TimeoutError('Prediction not ready after %s seconds' % timeout)
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _next_batch(self):
+        """ Blocks for the first request, then gathers more until the batch is full or its latency budget is spent.
+        Returns None once closed. """
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first.arrival + self.max_latency
+        while len(batch) < self.max_batch_size:
+            try:
+                request = self._queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)  # finish this batch, stop on the next call
+                break
+            batch.append(request)
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            n = len(batch)
+            for i, request in enumerate(batch):
+                self._buffer[i] = request.example
+            if self.pad:
+                self._buffer[n:] = 0
+            feed_dict = dict(self.feed_dict)
+            feed_dict[self.inputs] = self._buffer if self.pad else self._buffer[:n]
+            start = time.time()
+            try:
+                results = self.sess.run(self.outputs, feed_dict=feed_dict)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+            end = time.time()
+            for i, request in enumerate(batch):
+                request.result = [r[i] for r in results] if isinstance(results, (list, tuple)) else results[i]
+                request.done.set()
+            with self._lock:
+                self._num_requests += n
+                self._num_batches += 1
+                self._run_time += end - start
+                self._latencies.extend(end - request.arrival for request in batch)
+        while True:  # fail whatever was queued after close
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                request.error = RuntimeError('InferenceServer is closed')
+                request.done.set()